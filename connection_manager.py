@@ -0,0 +1,97 @@
+# SQLite3 has the functionality of SQL through Python
+import sqlite3
+
+# threading is used to give every thread its own connection
+import threading
+
+# contextmanager turns a generator into something that can be used in a with statement
+from contextlib import contextmanager
+
+# the file that holds the database
+DATABASE_PATH = 'database.db'
+
+# stores one connection per thread
+# SQLite connections can't be shared between threads, but each thread can keep reusing its own
+_local = threading.local()
+
+# opens a new connection and tunes it for this application
+def _open_connection():
+    # isolation_level=None stops Python from starting transactions on its own
+    # transactions are started explicitly in transaction() instead
+    conn = sqlite3.connect(DATABASE_PATH, isolation_level=None)
+
+    # lets maintenance give unused pages back to the file system a few at a time
+    # this has to come before anything else is written, so it only changes new databases
+    # older ones are converted the first time they're compacted
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+    # WAL (write-ahead logging) lets searches read while images are being written
+    # and only needs one fsync per commit instead of rewriting the whole page
+    conn.execute('PRAGMA journal_mode = WAL')
+    # in WAL mode NORMAL is still safe from corruption and skips an fsync on every commit
+    conn.execute('PRAGMA synchronous = NORMAL')
+    # keep temporary tables and indexes (used for sorting and grouping) in memory
+    conn.execute('PRAGMA temp_store = MEMORY')
+    # use up to about 64MB of memory to cache pages (negative numbers are in KB)
+    conn.execute('PRAGMA cache_size = -64000')
+    # wait for up to 5 seconds if another connection is writing instead of failing straight away
+    conn.execute('PRAGMA busy_timeout = 5000')
+
+    return conn
+
+# returns the connection for the current thread, opening it the first time it's needed
+def get_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _open_connection()
+        _local.conn = conn
+        _local.depth = 0
+
+    return conn
+
+# use as "with connection_manager.transaction() as cursor:"
+# everything inside the with block is committed together, or rolled back if an error happens
+# transactions can be nested, only the outermost one commits
+@contextmanager
+def transaction():
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    # a transaction is already open on this thread, so join it
+    if _local.depth > 0:
+        _local.depth += 1
+        try:
+            yield cursor
+        finally:
+            _local.depth -= 1
+        return
+
+    # IMMEDIATE takes the write lock straight away so two writers can't deadlock each other
+    cursor.execute('BEGIN IMMEDIATE')
+    _local.depth = 1
+    try:
+        yield cursor
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+    finally:
+        _local.depth = 0
+
+# runs a read-only query and returns every row
+def fetch_all(query, parameters=()):
+    return get_connection().execute(query, parameters).fetchall()
+
+# runs a read-only query and returns the first row, or None if there aren't any
+def fetch_one(query, parameters=()):
+    return get_connection().execute(query, parameters).fetchone()
+
+# closes the connection for the current thread
+# the next call to get_connection will open a new one
+def close_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+        _local.depth = 0
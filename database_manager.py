@@ -1,12 +1,18 @@
 # SQLite3 has the functionality of SQL through Python
-import sqlite3
+# connections are shared and managed by connection_manager
+import connection_manager
 
-# initializes the SQLite3 database which stores data about images
-def init_database():
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
+# the embeddings of faces in photos are kept in a memory-mapped file instead of the database
+import embedding_store
+
+# regex library used to turn typed requests into full-text queries
+import re
 
+# used to measure the size of the database file
+import os
+
+# version 1: the original tables
+def _create_tables(cursor):
     # creates the photos table with the path to the image, and optionally the time and location of the image
     cursor.execute('''CREATE TABLE IF NOT EXISTS photos (
             filepath TEXT UNIQUE NOT NULL,
@@ -49,337 +55,1197 @@ def init_database():
     
     # set up the default settings
     cursor.execute('INSERT OR IGNORE INTO settings VALUES (?, ?, ?, ?, ?)', (1, False, False, 25, '/'))
-    
-    # commit the changes and close the connection
-    conn.commit()
-    conn.close()
+
+# returns True if the table has a column with that name
+def _has_column(cursor, table, column):
+    cursor.execute(f'PRAGMA table_info({table})')
+    return column in [row[1] for row in cursor.fetchall()]
+
+# version 2: indexes for the columns that photos, tags and faces are looked up by
+# without these, every lookup and delete by filepath or tag has to scan the whole table
+def _create_indexes(cursor):
+    # later versions replace the filepath columns of photo_tags and photo_faces with ids
+    if _has_column(cursor, 'photo_tags', 'filepath'):
+        cursor.execute('CREATE INDEX IF NOT EXISTS photo_tags_filepath ON photo_tags (filepath)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS photo_tags_tag_name ON photo_tags (tag_name)')
+    if _has_column(cursor, 'photo_faces', 'filepath'):
+        cursor.execute('CREATE INDEX IF NOT EXISTS photo_faces_filepath ON photo_faces (filepath)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS photos_folder_path ON photos (folder_path)')
+
+# version 3: integer ids for photos and tags
+# each tag name is stored once in the tags table, and photo_tags and photo_faces refer to photos and tags by id
+# so joins compare integers and the same strings aren't repeated on every row
+def _normalize_tags(cursor):
+    # give photos an id that stays the same when the photo is updated
+    if not _has_column(cursor, 'photos', 'id'):
+        cursor.execute('''CREATE TABLE new_photos (
+                id INTEGER PRIMARY KEY,
+                filepath TEXT UNIQUE NOT NULL,
+                folder_path TEXT NOT NULL,
+                location TEXT,
+                timestamp TEXT
+                )''')
+        cursor.execute('''INSERT INTO new_photos (filepath, folder_path, location, timestamp)
+                SELECT filepath, folder_path, location, timestamp FROM photos''')
+        cursor.execute('DROP TABLE photos')
+        cursor.execute('ALTER TABLE new_photos RENAME TO photos')
+        cursor.execute('CREATE INDEX IF NOT EXISTS photos_folder_path ON photos (folder_path)')
+
+    # creates the tags table which stores each tag once
+    # photo_count is the number of photos with that tag, kept up to date by the triggers below
+    cursor.execute('''CREATE TABLE IF NOT EXISTS tags (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            photo_count INTEGER NOT NULL DEFAULT 0
+            )''')
+
+    # photo_tags becomes pairs of ids, and a photo can only have each tag once
+    if _has_column(cursor, 'photo_tags', 'tag_name'):
+        cursor.execute('INSERT OR IGNORE INTO tags (name) SELECT DISTINCT tag_name FROM photo_tags')
+        cursor.execute('ALTER TABLE photo_tags RENAME TO old_photo_tags')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS photo_tags (
+            photo_id INTEGER NOT NULL,
+            tag_id INTEGER NOT NULL,
+            PRIMARY KEY (photo_id, tag_id)
+            ) WITHOUT ROWID''')
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'old_photo_tags'")
+    if cursor.fetchone():
+        cursor.execute('''INSERT OR IGNORE INTO photo_tags
+                SELECT photos.id, tags.id FROM old_photo_tags
+                JOIN photos ON photos.filepath = old_photo_tags.filepath
+                JOIN tags ON tags.name = old_photo_tags.tag_name''')
+        cursor.execute('DROP TABLE old_photo_tags')
+    # the primary key already finds the tags of a photo, this finds the photos with a tag
+    cursor.execute('CREATE INDEX IF NOT EXISTS photo_tags_tag_id ON photo_tags (tag_id)')
+
+    # photo_faces refers to photos by id too
+    if _has_column(cursor, 'photo_faces', 'filepath'):
+        cursor.execute('ALTER TABLE photo_faces RENAME TO old_photo_faces')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS photo_faces (
+            photo_id INTEGER NOT NULL,
+            embedding BLOB NOT NULL
+            )''')
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'old_photo_faces'")
+    if cursor.fetchone():
+        cursor.execute('''INSERT INTO photo_faces
+                SELECT photos.id, old_photo_faces.embedding FROM old_photo_faces
+                JOIN photos ON photos.filepath = old_photo_faces.filepath''')
+        cursor.execute('DROP TABLE old_photo_faces')
+    cursor.execute('CREATE INDEX IF NOT EXISTS photo_faces_photo_id ON photo_faces (photo_id)')
+
+    # count the photos of every tag, then keep the counts up to date whenever photo_tags changes
+    cursor.execute('UPDATE tags SET photo_count = (SELECT COUNT(*) FROM photo_tags WHERE tag_id = tags.id)')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS photo_tags_insert AFTER INSERT ON photo_tags BEGIN
+            UPDATE tags SET photo_count = photo_count + 1 WHERE id = NEW.tag_id;
+            END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS photo_tags_delete AFTER DELETE ON photo_tags BEGIN
+            UPDATE tags SET photo_count = photo_count - 1 WHERE id = OLD.tag_id;
+            END''')
+
+# version 4: a full-text index of each photo's tags, face names, folder and file name
+# the rowid of each row is the id of the photo it describes
+def _create_search_index(cursor):
+    cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS photo_search USING fts5 (
+            tags,
+            faces,
+            folder,
+            filename
+            )''')
+
+    # index the photos that are already in the database
+    cursor.execute('SELECT id FROM photos')
+    _refresh_search_index(cursor, [row[0] for row in cursor.fetchall()])
+
+# version 5: deleting a photo also deletes its tags, faces and full-text index row
+# before this, removing a folder left those rows behind
+def _cascade_photo_deletes(cursor):
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS photos_delete AFTER DELETE ON photos BEGIN
+            DELETE FROM photo_tags WHERE photo_id = OLD.id;
+            DELETE FROM photo_faces WHERE photo_id = OLD.id;
+            DELETE FROM photo_search WHERE rowid = OLD.id;
+            END''')
+
+# the number of old embeddings _move_embeddings_to_store reads at a time, so a big library doesn't have to fit in memory
+MIGRATION_CHUNK_SIZE = 10000
+
+# version 6: face embeddings move out of photo_faces into the file managed by embedding_store
+# each row of photo_faces now has the slot of its embedding in that file and the bounding box of the face
+def _move_embeddings_to_store(cursor):
+    # the generation of the embedding file that's currently in use, changed when the file is compacted
+    cursor.execute('CREATE TABLE IF NOT EXISTS embedding_files (generation INTEGER NOT NULL)')
+    cursor.execute('INSERT INTO embedding_files SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM embedding_files)')
+
+    if _has_column(cursor, 'photo_faces', 'embedding'):
+        cursor.execute('ALTER TABLE photo_faces RENAME TO old_photo_faces')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS photo_faces (
+            id INTEGER PRIMARY KEY,
+            photo_id INTEGER NOT NULL,
+            slot INTEGER NOT NULL,
+            x1 REAL,
+            y1 REAL,
+            x2 REAL,
+            y2 REAL
+            )''')
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'old_photo_faces'")
+    if cursor.fetchone():
+        # copy the old embeddings to the file a chunk at a time
+        # the rows are inserted with a second cursor so the one reading old_photo_faces isn't reset
+        generation = _get_embedding_generation(cursor)
+        insert_cursor = cursor.connection.cursor()
+        cursor.execute('SELECT photo_id, embedding FROM old_photo_faces')
+        while True:
+            rows = cursor.fetchmany(MIGRATION_CHUNK_SIZE)
+            if not rows:
+                break
+            slots = embedding_store.append(generation, embedding_store.blobs_to_matrix([row[1] for row in rows]))
+            insert_cursor.executemany('INSERT INTO photo_faces (photo_id, slot) VALUES (?, ?)', [(row[0], slot) for row, slot in zip(rows, slots)])
+        cursor.execute('DROP TABLE old_photo_faces')
+    cursor.execute('CREATE INDEX IF NOT EXISTS photo_faces_photo_id ON photo_faces (photo_id)')
+
+# version 7: groups of faces that are likely to be the same person
+# each cluster keeps the average of its faces' embeddings (the centroid) and the name given to it, if any
+def _create_face_clusters(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS face_clusters (
+            id INTEGER PRIMARY KEY,
+            centroid BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            name TEXT
+            )''')
+
+    # the cluster each face belongs to, NULL until the clustering job has seen it
+    if not _has_column(cursor, 'photo_faces', 'cluster_id'):
+        cursor.execute('ALTER TABLE photo_faces ADD COLUMN cluster_id INTEGER')
+    cursor.execute('CREATE INDEX IF NOT EXISTS photo_faces_cluster_id ON photo_faces (cluster_id)')
+
+# version 8: everything the details window needs to show a photo's faces is stored when the photo is processed
+# so opening a photo never has to run InsightFace again
+def _store_face_detections(cursor):
+    # how confident InsightFace was that each face is a face, and a small JPEG of the face
+    if not _has_column(cursor, 'photo_faces', 'det_score'):
+        cursor.execute('ALTER TABLE photo_faces ADD COLUMN det_score REAL')
+    if not _has_column(cursor, 'photo_faces', 'thumbnail'):
+        cursor.execute('ALTER TABLE photo_faces ADD COLUMN thumbnail BLOB')
+
+    # 1 once the faces of a photo have been stored this way
+    # photos processed before this version stay at 0 until they're processed again
+    if not _has_column(cursor, 'photos', 'faces_indexed'):
+        cursor.execute('ALTER TABLE photos ADD COLUMN faces_indexed INTEGER NOT NULL DEFAULT 0')
+
+# version 9: the fingerprint of each photo's file, so a re-scan can tell which files changed
+# size is in bytes, mtime is the time the file was last modified in nanoseconds, and content_hash is a hash of its bytes
+# all three are NULL for photos processed before this version until their fingerprint is recorded
+def _add_fingerprints(cursor):
+    if not _has_column(cursor, 'photos', 'size'):
+        cursor.execute('ALTER TABLE photos ADD COLUMN size INTEGER')
+    if not _has_column(cursor, 'photos', 'mtime'):
+        cursor.execute('ALTER TABLE photos ADD COLUMN mtime INTEGER')
+    if not _has_column(cursor, 'photos', 'content_hash'):
+        cursor.execute('ALTER TABLE photos ADD COLUMN content_hash TEXT')
+    # used to find a photo that was moved or copied by the hash of its file
+    cursor.execute('CREATE INDEX IF NOT EXISTS photos_content_hash ON photos (content_hash)')
+
+# version 10: a perceptual hash of each photo, which is almost the same for images that look almost the same
+# the 64 bit hash is also split into 4 bands of 16 bits, each with an index
+# two hashes that differ in at most 3 bits have at least one band that's the same, so near duplicates are found with an index lookup
+def _create_photo_hashes(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS photo_hashes (
+            photo_id INTEGER PRIMARY KEY,
+            hash INTEGER NOT NULL,
+            band0 INTEGER NOT NULL,
+            band1 INTEGER NOT NULL,
+            band2 INTEGER NOT NULL,
+            band3 INTEGER NOT NULL
+            )''')
+    for band in range(HASH_BANDS):
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS photo_hashes_band{band} ON photo_hashes (band{band})')
+
+    # deleting a photo deletes its hash too
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS photos_delete_hash AFTER DELETE ON photos BEGIN
+            DELETE FROM photo_hashes WHERE photo_id = OLD.id;
+            END''')
+
+# version 11: numeric location and time columns
+# latitude and longitude are stored in decimal degrees and taken_at in seconds since 1970
+# so searches compare numbers instead of parsing the location and timestamp text of every photo
+def _add_numeric_metadata(cursor):
+    if _has_column(cursor, 'photos', 'latitude'):
+        return
+
+    cursor.execute('ALTER TABLE photos ADD COLUMN latitude REAL')
+    cursor.execute('ALTER TABLE photos ADD COLUMN longitude REAL')
+    cursor.execute('ALTER TABLE photos ADD COLUMN taken_at INTEGER')
+
+    # convert the old text, where location is "latitude,longitude" and timestamp is "YYYY:MM:DD HH:MM:SS"
+    cursor.execute('''UPDATE photos SET
+            latitude = CAST(substr(location, 1, instr(location, ',') - 1) AS REAL),
+            longitude = CAST(substr(location, instr(location, ',') + 1) AS REAL)
+            WHERE instr(location, ',') > 0''')
+    # strftime reads the time as UTC, the same way image_processing stores EXIF times that don't have a time zone
+    cursor.execute('''UPDATE photos SET
+            taken_at = CAST(strftime('%s', replace(substr(timestamp, 1, 10), ':', '-') || substr(timestamp, 11, 9)) AS INTEGER)
+            WHERE timestamp IS NOT NULL''')
+    # the text columns aren't used anymore, they're emptied instead of dropped since older versions of SQLite can't drop columns
+    cursor.execute('UPDATE photos SET location = NULL, timestamp = NULL')
+
+# every change to the structure of the database, in order
+# the database is at version n once the first n migrations have run
+# to change the database, add a new function to the end of this list instead of editing the old ones
+# migrations have to be safe to run again on a database that already has them (e.g. use IF NOT EXISTS)
+# because reset_table runs all of them again to rebuild the table it dropped
+MIGRATIONS = [
+    _create_tables,
+    _create_indexes,
+    _normalize_tags,
+    _create_search_index,
+    _cascade_photo_deletes,
+    _move_embeddings_to_store,
+    _create_face_clusters,
+    _store_face_detections,
+    _add_fingerprints,
+    _create_photo_hashes,
+    _add_numeric_metadata,
+]
+
+# returns the version of the database, 0 if it has never been migrated
+def _get_schema_version(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+    cursor.execute('SELECT version FROM schema_version')
+    data = cursor.fetchone()
+
+    return data[0] if data else 0
+
+# initializes the SQLite3 database which stores data about images
+# databases made by older versions are upgraded in place by running the migrations they're missing
+def init_database():
+    with connection_manager.transaction() as cursor:
+        # stop ALTER TABLE ... RENAME from rewriting the triggers that use a table when a migration renames it
+        cursor.execute('PRAGMA legacy_alter_table = ON')
+        version = _get_schema_version(cursor)
+
+        # run every migration the database doesn't have yet
+        for migration in MIGRATIONS[version:]:
+            migration(cursor)
+
+        # record the new version
+        cursor.execute('DELETE FROM schema_version')
+        cursor.execute('INSERT INTO schema_version VALUES (?)', (len(MIGRATIONS),))
+        cursor.execute('PRAGMA legacy_alter_table = OFF')
+
+    # read the settings into memory so they never have to be read from the database again
+    settings.load()
 
 # reset all tables from the database
 def reset_database():
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-
-    # remove the tables in the database
-    cursor.execute('DROP TABLE IF EXISTS photos')
-    cursor.execute('DROP TABLE IF EXISTS tags')
-    cursor.execute('DROP TABLE IF EXISTS photo_tags')
-    cursor.execute('DROP TABLE IF EXISTS faces')
-    cursor.execute('DROP TABLE IF EXISTS photo_faces')
-    cursor.execute('DROP TABLE IF EXISTS folders')
-    cursor.execute('DROP TABLE IF EXISTS settings')
-
-    # commit the changes and close the connection
-    conn.commit()
-    conn.close()
+    with connection_manager.transaction() as cursor:
+        # remove the tables in the database
+        cursor.execute('DROP TABLE IF EXISTS photos')
+        cursor.execute('DROP TABLE IF EXISTS tags')
+        cursor.execute('DROP TABLE IF EXISTS photo_tags')
+        cursor.execute('DROP TABLE IF EXISTS faces')
+        cursor.execute('DROP TABLE IF EXISTS photo_faces')
+        cursor.execute('DROP TABLE IF EXISTS folders')
+        cursor.execute('DROP TABLE IF EXISTS settings')
+        cursor.execute('DROP TABLE IF EXISTS photo_search')
+        cursor.execute('DROP TABLE IF EXISTS embedding_files')
+        cursor.execute('DROP TABLE IF EXISTS face_clusters')
+        cursor.execute('DROP TABLE IF EXISTS photo_hashes')
+        cursor.execute('DROP TABLE IF EXISTS schema_version')
+
+    # let go of the old embedding file before deleting it
+    _notify_face_listeners(None, None, None)
+    _notify_photo_face_listeners()
+    embedding_store.remove_unused()
 
     init_database()
 
 # remove one table from the database and reset it
 # useful when there's an error with a table but you don't want to reset everything
 def reset_table(table):
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-
-    # remove the selected table in the database
-    cursor.execute(f'DROP TABLE IF EXISTS {table}')
-
-    # commit the changes and close the connection
-    conn.commit()
-    conn.close()
+    with connection_manager.transaction() as cursor:
+        # remove the selected table in the database
+        cursor.execute(f'DROP TABLE IF EXISTS {table}')
+        # run every migration again so the table is rebuilt with its indexes
+        cursor.execute('DROP TABLE IF EXISTS schema_version')
 
     init_database()
+    _notify_face_listeners(None, None, None)
+    _notify_photo_face_listeners()
 
+# returns (latitude, longitude, taken_at) of a photo, each of which can be None
 def get_photo(filepath):
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
-    # sets the photos variable to a list of tuples corresponding to every row in the photos table from the database
-    cursor.execute('SELECT * FROM photos WHERE filepath = ?', (filepath,))
-    data = cursor.fetchone()
-
-    # close the connection to the database
-    conn.close()
-
-    return data[2:]
+    # get the row in the photos table with that filepath
+    return connection_manager.fetch_one('SELECT latitude, longitude, taken_at FROM photos WHERE filepath = ?', (filepath,))
+
+# groups rows of (photo_id, value) that are sorted by photo_id into (photo_id, [values]) pairs
+def _group_by_photo(rows):
+    current_photo_id = None
+    values = []
+
+    for photo_id, value in rows:
+        if photo_id != current_photo_id:
+            if values:
+                yield current_photo_id, values
+            current_photo_id = photo_id
+            values = []
+        values.append(value)
+
+    if values:
+        yield current_photo_id, values
+
+# yields the data from every photo in the database one at a time
+# each entry is a tuple (filepath: str, folder_path: str, location: (latitude, longitude), taken_at: int, tags: list[str], faces: list[embedding])
+def iter_all_photos():
+    conn = connection_manager.get_connection()
+
+    # read the three tables at once, each sorted by photo id
+    # this way they can be merged together in one pass instead of querying the tags and faces of every photo separately
+    photos = conn.execute('SELECT id, filepath, folder_path, latitude, longitude, taken_at FROM photos ORDER BY id')
+    tag_groups = _group_by_photo(conn.execute('''SELECT photo_tags.photo_id, tags.name FROM photo_tags
+            JOIN tags ON tags.id = photo_tags.tag_id ORDER BY photo_tags.photo_id'''))
+    face_groups = _group_by_photo(conn.execute('SELECT photo_id, slot FROM photo_faces ORDER BY photo_id'))
+    embeddings = embedding_store.open_matrix(get_embedding_generation())
+
+    next_tags = next(tag_groups, None)
+    next_faces = next(face_groups, None)
+
+    for photo_id, filepath, folder_path, latitude, longitude, taken_at in photos:
+        # skip over any tags and faces that belong to photos which aren't in the photos table anymore
+        while next_tags and next_tags[0] < photo_id:
+            next_tags = next(tag_groups, None)
+        while next_faces and next_faces[0] < photo_id:
+            next_faces = next(face_groups, None)
+
+        tags = []
+        if next_tags and next_tags[0] == photo_id:
+            tags = next_tags[1]
+            next_tags = next(tag_groups, None)
+
+        faces = []
+        if next_faces and next_faces[0] == photo_id:
+            faces = [embeddings[slot] for slot in next_faces[1]]
+            next_faces = next(face_groups, None)
+
+        yield (filepath, folder_path, _to_location(latitude, longitude), taken_at, tags, faces)
 
 # returns the data from every photo in the database
+# each entry in the list will be a tuple (filepath: str, folder_path: str, location: (latitude, longitude), taken_at: int, tags: list[str], faces: list[embedding])
 def get_all_photos():
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
-    # sets the photos variable to a list of tuples corresponding to every row in the photos table from the database
-    cursor.execute('SELECT * FROM photos')
-    photos = cursor.fetchall()
-
-    # stores the data about each photo
-    # each entry in the list will be a tuple (filepath: str, folder_path: str, location: str, timestamp: str, tags: list[str], faces: list[blob])
-    photo_data = []
-
-    for photo in photos:
-        # unpack the data from the photo tuple
-        filepath, folder_path, location, timestamp = photo
-
-        # get a list of all entries in photo_tags with that filepath
-        cursor.execute('SELECT * FROM photo_tags WHERE filepath = ?', (filepath,))
-        tag_data = cursor.fetchall()
-        tags = [tag[1] for tag in tag_data]
-
-        cursor.execute('SELECT * from photo_faces WHERE filepath = ?', (filepath,))
-        face_data = cursor.fetchall()
-        faces = [face[1] for face in face_data]
-
-        # add this data to a tuple and append it to the photo_data list
-        photo_data.append((filepath, folder_path, location, timestamp, tags, faces))
-
-    # close the connection to the database
-    conn.close()
-
-    return photo_data
+    return list(iter_all_photos())
+
+# finds every photo that has at least one of the request tags
+# returns a list of tuples (filepath: str, latitude: float, longitude: float, taken_at: int, match_count: int)
+# photo_tags is used as an inverted index so only photos with a matching tag are read, not the whole library
+def search_photos_by_tags(request_tags):
+    # no photos can match if there are no tags
+    if not request_tags:
+        return []
+
+    # remove duplicate tags so each match is only counted once
+    request_tags = list(set(request_tags))
+    placeholders = ', '.join('?' * len(request_tags))
+
+    # count how many of each photo's tags are in the request, only looking at photos with a matching tag
+    return connection_manager.fetch_all(f'''SELECT photos.filepath, photos.latitude, photos.longitude, photos.taken_at, matches.match_count
+            FROM (SELECT photo_id, COUNT(*) AS match_count FROM photo_tags
+                  WHERE tag_id IN (SELECT id FROM tags WHERE name IN ({placeholders})) GROUP BY photo_id) AS matches
+            JOIN photos ON photos.id = matches.photo_id''', request_tags)
 
 # get a list of all the tags in the database
 def get_found_tags():
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
-    # get every entry in photo_tags and map the list to only tags
-    cursor.execute('SELECT * FROM photo_tags')
-    photo_tags = cursor.fetchall()
-    tags = set([tag[1] for tag in photo_tags])
-
-    # close the connection to the database
-    conn.close()
-
-    return tags
+    # the tags table has one row per tag, so there's no need to read photo_tags
+    tags = connection_manager.fetch_all('SELECT name FROM tags WHERE photo_count > 0')
+
+    return set([tag[0] for tag in tags])
+
+# splits a list into lists of at most size items
+# used to keep the number of ? in a query under SQLite's limit
+def _chunks(items, size=500):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+# rebuilds the full-text index rows of the photos with these ids
+# has to be called in the same transaction as any change to a photo's tags, folder or path
+def _refresh_search_index(cursor, photo_ids):
+    for chunk in _chunks(list(photo_ids)):
+        placeholders = ', '.join('?' * len(chunk))
+        cursor.execute(f'DELETE FROM photo_search WHERE rowid IN ({placeholders})', chunk)
+
+        # tags holds every tag of the photo and faces only the tags that are names of saved faces
+        # the file name is the end of the filepath after its folder
+        cursor.execute(f'''INSERT INTO photo_search (rowid, tags, faces, folder, filename)
+                SELECT photos.id,
+                (SELECT group_concat(tags.name, ' ') FROM photo_tags JOIN tags ON tags.id = photo_tags.tag_id
+                 WHERE photo_tags.photo_id = photos.id),
+                (SELECT group_concat(tags.name, ' ') FROM photo_tags JOIN tags ON tags.id = photo_tags.tag_id
+                 WHERE photo_tags.photo_id = photos.id AND tags.name IN (SELECT lower(name) FROM faces)),
+                photos.folder_path,
+                substr(photos.filepath, length(photos.folder_path) + 2)
+                FROM photos WHERE photos.id IN ({placeholders})''', chunk)
+
+# returns the ids of every photo that has a tag
+def _get_photo_ids_with_tag(cursor, tag_name):
+    cursor.execute('SELECT photo_id FROM photo_tags WHERE tag_id = (SELECT id FROM tags WHERE name = ?)', (tag_name,))
+    return [row[0] for row in cursor.fetchall()]
+
+# turns a typed request like 'beach 2019 "alice smith"' into an FTS5 query
+# words match anything starting with them and text in double quotes has to appear as a phrase
+# returns None if there's nothing to search for
+def _to_search_query(text):
+    # take out the phrases first so their words aren't also searched on their own
+    phrases = re.findall(r'"([^"]*)"', text)
+    words = re.findall(r'\w+', re.sub(r'"[^"]*"', ' ', text))
+
+    # every term is quoted so FTS5 doesn't treat words like AND or OR as operators
+    terms = ['"' + ' '.join(re.findall(r'\w+', phrase)) + '"' for phrase in phrases if re.search(r'\w', phrase)]
+    terms += [f'"{word}"*' for word in words]
+
+    return ' AND '.join(terms) if terms else None
+
+# finds the photos matching every word of a typed request using the full-text index
+# returns up to max_photos filepaths, best matches first (ranked by BM25), or an empty list if nothing matched
+def full_text_search(text, max_photos):
+    query = _to_search_query(text)
+    if not query:
+        return []
+
+    photos = connection_manager.fetch_all('''SELECT photos.filepath FROM photo_search
+            JOIN photos ON photos.id = photo_search.rowid
+            WHERE photo_search MATCH ? ORDER BY photo_search.rank LIMIT ?''', (query, max_photos))
+
+    return [photo[0] for photo in photos]
 
 # returns True if the filepath exists in the database, otherwise returns False
 def is_photo_in_database(filepath):
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
     # Get an entry with the filepath from the database
-    cursor.execute('SELECT 1 FROM photos WHERE filepath = ?', (filepath,))
-    result = cursor.fetchone()
-
-    # close the connection to the database
-    conn.close()
+    result = connection_manager.fetch_one('SELECT 1 FROM photos WHERE filepath = ?', (filepath,))
 
     return True if result else False
 
-# adds a tag to an photo
-def add_tag_to_photo(filepath, tag_name):
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
-    # add the name and embedding to the database
-    cursor.execute('INSERT INTO photo_tags VALUES (?, ?)', (filepath, tag_name))
+# adds a tag to many photos in one transaction
+def add_tag_to_photos(filepaths, tag_name):
+    filepaths = list(filepaths)
 
-    # commit changes and close the connection
-    conn.commit()
-    conn.close()
+    with connection_manager.transaction() as cursor:
+        # make sure the tag exists, then connect it to the photos
+        cursor.execute('INSERT OR IGNORE INTO tags (name) VALUES (?)', (tag_name,))
+        cursor.executemany('''INSERT OR IGNORE INTO photo_tags
+                SELECT photos.id, tags.id FROM photos, tags WHERE photos.filepath = ? AND tags.name = ?''',
+                [(filepath, tag_name) for filepath in filepaths])
 
+        # update the full-text index with the new tag
+        photo_ids = []
+        for chunk in _chunks(filepaths):
+            cursor.execute(f'SELECT id FROM photos WHERE filepath IN ({", ".join("?" * len(chunk))})', chunk)
+            photo_ids += [row[0] for row in cursor.fetchall()]
+        _refresh_search_index(cursor, photo_ids)
 
-# adds a photo to the database once it's detected
-def add_photo_to_database(filepath, folder_path, location, timestamp, tags, face_embeddings):
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-
-    # add the data from the image to the photos table
-    cursor.execute('INSERT OR REPLACE INTO photos VALUES (?, ?, ?, ?)', (filepath, folder_path, location, timestamp))
+# adds a tag to an photo
+def add_tag_to_photo(filepath, tag_name):
+    add_tag_to_photos([filepath], tag_name)
+
+# the number of photos written to the database in each transaction by add_photos_to_database
+INGEST_BATCH_SIZE = 64
+
+# the columns add_photos_to_database and copy_photos write, and how a photo that's already in the database is updated
+# photos that are already in the database are updated instead of replaced so they keep the same id
+_PHOTO_COLUMNS = '(filepath, folder_path, latitude, longitude, taken_at, faces_indexed, size, mtime, content_hash)'
+_PHOTO_UPDATE = '''folder_path = excluded.folder_path, latitude = excluded.latitude, longitude = excluded.longitude,
+        taken_at = excluded.taken_at, faces_indexed = 1, size = excluded.size, mtime = excluded.mtime, content_hash = excluded.content_hash'''
+
+# turns the latitude and longitude columns into a location of (latitude, longitude), or None if the photo doesn't have one
+def _to_location(latitude, longitude):
+    return None if latitude is None or longitude is None else (latitude, longitude)
+
+# turns a location of (latitude, longitude) or None into the values of the latitude and longitude columns
+def _from_location(location):
+    return tuple(location) if location else (None, None)
+
+# adds many photos to the database at once
+# photos is a list (or any iterable) of tuples (filepath, folder_path, location, taken_at, tags, faces)
+# location is (latitude, longitude) or None, and taken_at is the time the photo was taken in seconds since 1970 or None
+# faces is a list of tuples (embedding, bbox, det_score, thumbnail) where bbox is (x1, y1, x2, y2) and thumbnail is JPEG bytes
+# a photo can also have a seventh item, the fingerprint of its file (size, mtime, content_hash, perceptual_hash)
+# the photos are written batch_size at a time, with one transaction per batch instead of one per photo
+def add_photos_to_database(photos, batch_size=INGEST_BATCH_SIZE):
+    batch = []
+    for photo in photos:
+        batch.append(photo)
+        if len(batch) >= batch_size:
+            _write_photo_batch(batch)
+            batch = []
+
+    # write the photos left over in the last batch
+    if batch:
+        _write_photo_batch(batch)
+
+# writes one batch of photos in a single transaction
+def _write_photo_batch(batch):
+    filepaths = [photo[0] for photo in batch]
+    tag_names = list(set(tag for photo in batch for tag in photo[4]))
+
+    with connection_manager.transaction() as cursor:
+        # add the data from the images to the photos table
+        # photos that are already in the database are updated so they keep the same id
+        # their faces are stored below, so they're marked as having their faces indexed
+        cursor.executemany(f'''INSERT INTO photos {_PHOTO_COLUMNS} VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?)
+                ON CONFLICT (filepath) DO UPDATE SET {_PHOTO_UPDATE}''',
+                [(*photo[:2], *_from_location(photo[2]), photo[3], *(photo[6][:3] if len(photo) > 6 else (None,) * 3)) for photo in batch])
+
+        # look up the ids of the photos
+        cursor.execute(f'SELECT filepath, id FROM photos WHERE filepath IN ({", ".join("?" * len(filepaths))})', filepaths)
+        photo_ids = dict(cursor.fetchall())
+
+        # add any new tags to the tags table and look up the ids of all of them
+        cursor.executemany('INSERT OR IGNORE INTO tags (name) VALUES (?)', [(tag,) for tag in tag_names])
+        cursor.execute(f'SELECT name, id FROM tags WHERE name IN ({", ".join("?" * len(tag_names))})', tag_names)
+        tag_ids = dict(cursor.fetchall())
+
+        # remove old tags and face embeddings associated with those photos before adding new ones
+        cursor.executemany('DELETE FROM photo_tags WHERE photo_id = ?', [(photo_id,) for photo_id in photo_ids.values()])
+        cursor.executemany('DELETE FROM photo_faces WHERE photo_id = ?', [(photo_id,) for photo_id in photo_ids.values()])
+
+        # add a connection from each photo to each of its tags
+        # this allows one photo to be associated with multiple tags
+        cursor.executemany('INSERT OR IGNORE INTO photo_tags VALUES (?, ?)',
+                [(photo_ids[photo[0]], tag_ids[tag]) for photo in batch for tag in photo[4]])
+        # write the face embeddings to the embedding file, then connect each photo to the slots they were written to
+        faces = [(photo_ids[photo[0]], *face[1:]) for photo in batch for face in photo[5]]
+        slots = embedding_store.append(_get_embedding_generation(cursor), [face[0] for photo in batch for face in photo[5]])
+        cursor.executemany('''INSERT INTO photo_faces (photo_id, slot, x1, y1, x2, y2, det_score, thumbnail)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                [(photo_id, slot, *bbox, det_score, thumbnail) for (photo_id, bbox, det_score, thumbnail), slot in zip(faces, slots)])
 
-    # remove old tags and face embeddings associated with that filepath before adding new ones
-    cursor.execute('DELETE FROM photo_tags WHERE filepath = ?', (filepath,))
-    cursor.execute('DELETE FROM photo_faces WHERE filepath = ?', (filepath,))
+        # save the perceptual hashes so later near duplicates of these photos can be found
+        _save_perceptual_hashes(cursor, [(photo_ids[photo[0]], photo[6][3]) for photo in batch if len(photo) > 6])
 
-    # iterate through tags and add each entry to the photo_tags database
-    for tag in tags:        
-        # add a connection from the filepath to the tag
-        # this allows one photo to be associated with multiple tags
-        cursor.execute('INSERT INTO photo_tags VALUES (?, ?)', (filepath, tag))
+        # update the full-text index with the new tags
+        _refresh_search_index(cursor, photo_ids.values())
 
-    for embedding in face_embeddings:
-        # do the same thing with the face embeddings
-        cursor.execute('INSERT INTO photo_faces VALUES (?, ?)', (filepath, embedding))
+    _notify_photo_face_listeners()
 
-    # commit the changes and close the connection
-    conn.commit()
-    conn.close()
+# adds a photo to the database once it's detected
+def add_photo_to_database(filepath, folder_path, location, taken_at, tags, faces):
+    add_photos_to_database([(filepath, folder_path, location, taken_at, tags, faces)])
+
+# returns the fingerprint stored for a photo as (size, mtime, content_hash, perceptual_hash), or None if it isn't in the database
+def get_fingerprint(filepath):
+    data = connection_manager.fetch_one('''SELECT photos.size, photos.mtime, photos.content_hash, photo_hashes.hash FROM photos
+            LEFT JOIN photo_hashes ON photo_hashes.photo_id = photos.id WHERE photos.filepath = ?''', (filepath,))
+    if data is None:
+        return None
+
+    return (*data[:3], _from_signed(data[3]))
+
+# returns the filepath of a photo whose file has this hash, other than filepath itself, or None if there isn't one
+# only photos with stored faces are used, so copying from them never needs the models
+def find_photo_by_hash(content_hash, filepath):
+    data = connection_manager.fetch_one('''SELECT filepath FROM photos
+            WHERE content_hash = ? AND filepath != ? AND faces_indexed = 1 LIMIT 1''', (content_hash, filepath))
+
+    return data[0] if data else None
+
+# updates the location and time of photos without touching their tags or faces
+# photos is a list (or any iterable) of tuples (filepath, location, taken_at) like image_processing.get_images_metadata yields
+def set_photo_metadata(photos):
+    with connection_manager.transaction() as cursor:
+        cursor.executemany('UPDATE photos SET latitude = ?, longitude = ?, taken_at = ? WHERE filepath = ?',
+                ((*_from_location(location), taken_at, filepath) for filepath, location, taken_at in photos))
+
+# records the fingerprints of photos whose contents haven't changed
+# fingerprints is a list of tuples (filepath, size, mtime, content_hash, perceptual_hash)
+def set_fingerprints(fingerprints):
+    with connection_manager.transaction() as cursor:
+        cursor.executemany('UPDATE photos SET size = ?, mtime = ?, content_hash = ? WHERE filepath = ?',
+                [(size, mtime, content_hash, filepath) for filepath, size, mtime, content_hash, _ in fingerprints])
+
+        photo_hashes = []
+        for filepath, _, _, _, perceptual_hash in fingerprints:
+            cursor.execute('SELECT id FROM photos WHERE filepath = ?', (filepath,))
+            data = cursor.fetchone()
+            if data:
+                photo_hashes.append((data[0], perceptual_hash))
+        _save_perceptual_hashes(cursor, photo_hashes)
+
+# the number of bands the perceptual hash is split into, and the number of bits in each
+HASH_BANDS = 4
+HASH_BAND_BITS = 16
+
+# the most bits two perceptual hashes can differ by for their photos to count as near duplicates
+# with 4 bands, every near duplicate within 3 bits is guaranteed to be found
+DUPLICATE_DISTANCE = 3
+
+# SQLite integers are signed, so hashes with the top bit set are stored as negative numbers
+def _to_signed(perceptual_hash):
+    return perceptual_hash - (1 << 64) if perceptual_hash >= (1 << 63) else perceptual_hash
+
+def _from_signed(stored_hash):
+    return stored_hash & ((1 << 64) - 1) if stored_hash is not None else None
+
+# splits a hash into its bands, from the lowest bits to the highest
+def _hash_bands(perceptual_hash):
+    mask = (1 << HASH_BAND_BITS) - 1
+    return [(perceptual_hash >> (band * HASH_BAND_BITS)) & mask for band in range(HASH_BANDS)]
+
+# the number of bits two hashes differ by
+def _hash_distance(hash1, hash2):
+    return bin(hash1 ^ hash2).count('1')
+
+# a hash needs at least this many bits set and this many unset to describe an image
+# flat images all hash to 0 and smooth gradients to almost all 0s or all 1s, so they'd all look like duplicates of each other
+MIN_HASH_BITS = 8
+
+# returns True if a hash says enough about its image for it to be compared with others
+def _is_distinctive(perceptual_hash):
+    bits = bin(perceptual_hash).count('1')
+    return MIN_HASH_BITS <= bits <= HASH_BANDS * HASH_BAND_BITS - MIN_HASH_BITS
+
+# saves perceptual hashes, photo_hashes is a list of (photo_id, perceptual_hash) where the hash can be None if it isn't known
+def _save_perceptual_hashes(cursor, photo_hashes):
+    photo_hashes = [(photo_id, perceptual_hash) for photo_id, perceptual_hash in photo_hashes if perceptual_hash is not None]
+    cursor.executemany('INSERT OR REPLACE INTO photo_hashes VALUES (?, ?, ?, ?, ?, ?)',
+            [(photo_id, _to_signed(perceptual_hash), *_hash_bands(perceptual_hash)) for photo_id, perceptual_hash in photo_hashes])
+
+# returns [(filepath, perceptual_hash)] of every photo sharing a band with the hash, the only photos that can be near duplicates of it
+def _get_hash_candidates(perceptual_hash, only_indexed=False):
+    bands = _hash_bands(perceptual_hash)
+    conditions = ' OR '.join(f'photo_hashes.band{band} = ?' for band in range(HASH_BANDS))
+    rows = connection_manager.fetch_all(f'''SELECT photos.filepath, photo_hashes.hash FROM photo_hashes
+            JOIN photos ON photos.id = photo_hashes.photo_id
+            WHERE ({conditions}){' AND photos.faces_indexed = 1' if only_indexed else ''}''', bands)
+
+    return [(filepath, _from_signed(stored_hash)) for filepath, stored_hash in rows]
+
+# returns the filepath of the photo that looks the most like an image with this perceptual hash, other than filepath itself
+# or None if no photo is within max_distance bits
+# only photos with stored faces are used, so copying from them never needs the models
+def find_near_duplicate(perceptual_hash, filepath, max_distance=DUPLICATE_DISTANCE):
+    # both hashes have to be distinctive, since one that's close to the limit can be within max_distance of one that's past it
+    if not _is_distinctive(perceptual_hash):
+        return None
+
+    best_filepath = None
+    best_distance = max_distance + 1
+    for candidate_filepath, candidate_hash in _get_hash_candidates(perceptual_hash, only_indexed=True):
+        distance = _hash_distance(perceptual_hash, candidate_hash)
+        if candidate_filepath != filepath and distance < best_distance and _is_distinctive(candidate_hash):
+            best_filepath = candidate_filepath
+            best_distance = distance
+
+    return best_filepath
+
+# returns the filepaths of every photo that's a near duplicate of a photo, most similar first
+def get_duplicates_of(filepath, max_distance=DUPLICATE_DISTANCE):
+    fingerprint = get_fingerprint(filepath)
+    if fingerprint is None or fingerprint[3] is None or not _is_distinctive(fingerprint[3]):
+        return []
+
+    candidates = [(_hash_distance(fingerprint[3], candidate_hash), candidate_filepath)
+                  for candidate_filepath, candidate_hash in _get_hash_candidates(fingerprint[3])
+                  if candidate_filepath != filepath and _is_distinctive(candidate_hash)]
+
+    return [candidate_filepath for distance, candidate_filepath in sorted(candidates) if distance <= max_distance]
+
+# returns every group of photos that are near duplicates of each other, as a list of lists of filepaths
+# photos are in the same group if they're connected by a chain of near duplicates
+def get_duplicate_groups(max_distance=DUPLICATE_DISTANCE):
+    # find every pair of photos that share a band, using the band indexes
+    pairs = set()
+    for band in range(HASH_BANDS):
+        pairs.update(connection_manager.fetch_all(f'''SELECT first.photo_id, first.hash, second.photo_id, second.hash
+                FROM photo_hashes AS first JOIN photo_hashes AS second
+                ON second.band{band} = first.band{band} AND second.photo_id > first.photo_id'''))
+
+    # group the pairs that are close enough with a union-find, where parents maps each photo to another in its group
+    parents = {}
+    def find(photo_id):
+        while parents.setdefault(photo_id, photo_id) != photo_id:
+            parents[photo_id] = parents[parents[photo_id]]
+            photo_id = parents[photo_id]
+        return photo_id
+
+    for first_id, first_hash, second_id, second_hash in pairs:
+        first_hash, second_hash = _from_signed(first_hash), _from_signed(second_hash)
+        if (_is_distinctive(first_hash) and _is_distinctive(second_hash)
+                and _hash_distance(first_hash, second_hash) <= max_distance):
+            parents[find(second_id)] = find(first_id)
+
+    groups = {}
+    for photo_id in parents:
+        groups.setdefault(find(photo_id), []).append(photo_id)
+
+    # look up the filepaths of the photos in each group
+    filepaths = {}
+    photo_ids = list(parents)
+    for chunk in _chunks(photo_ids):
+        filepaths.update(connection_manager.fetch_all(f'SELECT id, filepath FROM photos WHERE id IN ({", ".join("?" * len(chunk))})', chunk))
+
+    return [[filepaths[photo_id] for photo_id in sorted(group)] for group in groups.values() if len(group) > 1]
+
+# adds photos that are copies of photos already in the database, without processing them again
+# copies is a list of tuples (source_filepath, filepath, folder_path, (size, mtime, content_hash, perceptual_hash), metadata)
+# each photo gets the tags and faces of its source, and the faces share the source's embeddings
+# metadata is the photo's own (location, taken_at), or None to use the source's (e.g. when the file is an exact copy)
+# if an exact copy was moved rather than copied, its source file doesn't exist anymore and the source photo is removed
+# unless the source's folder isn't available (e.g. its drive is unplugged), since then its file may still be there
+# returns the filepaths that couldn't be copied because their source isn't in the database anymore
+def copy_photos(copies):
+    missing = []
+    with connection_manager.transaction() as cursor:
+        cursor.execute('SELECT folder_path FROM folders')
+        folders = [row[0] for row in cursor.fetchall()]
+        photo_ids = []
+        moved_ids = set()
+        for source_filepath, filepath, folder_path, fingerprint, metadata in copies:
+            cursor.execute('SELECT id, filepath, latitude, longitude, taken_at FROM photos WHERE filepath = ?', (source_filepath,))
+            source = cursor.fetchone()
+            # the source may have been moved by an earlier copy, any other photo of the same file works just as well
+            if source is None and metadata is None:
+                cursor.execute('''SELECT id, filepath, latitude, longitude, taken_at FROM photos
+                        WHERE content_hash = ? AND filepath != ? AND faces_indexed = 1 LIMIT 1''', (fingerprint[2], filepath))
+                source = cursor.fetchone()
+            if source is None:
+                missing.append(filepath)
+                continue
+            source_id, source_filepath, latitude, longitude, taken_at = source
+            if metadata is not None:
+                (latitude, longitude), taken_at = _from_location(metadata[0]), metadata[1]
+
+            cursor.execute(f'''INSERT INTO photos {_PHOTO_COLUMNS} VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?)
+                    ON CONFLICT (filepath) DO UPDATE SET {_PHOTO_UPDATE}''',
+                    (filepath, folder_path, latitude, longitude, taken_at, *fingerprint[:3]))
+            cursor.execute('SELECT id FROM photos WHERE filepath = ?', (filepath,))
+            photo_id = cursor.fetchone()[0]
+            # an exact copy has the same perceptual hash as its source, so it's copied when the hash isn't given
+            if fingerprint[3] is None:
+                cursor.execute('''INSERT OR REPLACE INTO photo_hashes
+                        SELECT ?, hash, band0, band1, band2, band3 FROM photo_hashes WHERE photo_id = ?''', (photo_id, source_id))
+            else:
+                _save_perceptual_hashes(cursor, [(photo_id, fingerprint[3])])
+
+            # replace the photo's tags and faces with the source's
+            cursor.execute('DELETE FROM photo_tags WHERE photo_id = ?', (photo_id,))
+            cursor.execute('DELETE FROM photo_faces WHERE photo_id = ?', (photo_id,))
+            cursor.execute('INSERT INTO photo_tags SELECT ?, tag_id FROM photo_tags WHERE photo_id = ?', (photo_id, source_id))
+            # a slot can be shared since it's only dead once no row of photo_faces points to it
+            cursor.execute('''INSERT INTO photo_faces (photo_id, slot, x1, y1, x2, y2, cluster_id, det_score, thumbnail)
+                    SELECT ?, slot, x1, y1, x2, y2, cluster_id, det_score, thumbnail FROM photo_faces WHERE photo_id = ? ORDER BY id''',
+                    (photo_id, source_id))
+
+            photo_ids.append(photo_id)
+            # a near duplicate is a different file, so its source is never treated as moved
+            if metadata is None and not os.path.exists(source_filepath) and is_available(source_filepath, folders):
+                moved_ids.add(source_id)
+
+        # the photos whose files were moved are removed once every copy has been made
+        # so a later copy in the same batch can still use one as its source
+        moved_ids.difference_update(photo_ids)
+        for chunk in _chunks(list(moved_ids)):
+            cursor.execute(f'DELETE FROM photos WHERE id IN ({", ".join("?" * len(chunk))})', chunk)
+
+        _refresh_search_index(cursor, photo_ids)
+
+    _notify_photo_face_listeners()
+
+    return missing
+
+# functions that run after faces are added to or removed from photos, called with no arguments
+photo_face_listeners = []
+
+# runs callback every time the faces found in photos change
+def add_photo_face_listener(callback):
+    photo_face_listeners.append(callback)
+
+def _notify_photo_face_listeners():
+    for listener in photo_face_listeners:
+        listener()
+
+# returns the generation of the embedding file that's in use
+def _get_embedding_generation(cursor):
+    cursor.execute('SELECT generation FROM embedding_files')
+    return cursor.fetchone()[0]
+
+def get_embedding_generation():
+    return _get_embedding_generation(connection_manager.get_connection().cursor())
+
+# returns every face found in a photo as (filepaths, slots, embeddings)
+# the face in slot slots[i] is in the photo filepaths[i], and its embedding is row slots[i] of the embeddings matrix
+# embeddings is memory-mapped from the embedding file and also has rows for deleted faces, which no slot points to
+def get_photo_face_embeddings():
+    conn = connection_manager.get_connection()
+    rows = conn.execute('''SELECT photos.filepath, photo_faces.slot FROM photo_faces
+            JOIN photos ON photos.id = photo_faces.photo_id''').fetchall()
+    embeddings = embedding_store.open_matrix(_get_embedding_generation(conn.cursor()))
+
+    return [row[0] for row in rows], [row[1] for row in rows], embeddings
+
+# the fraction of the embedding file that has to be unused before compact_embeddings rewrites it
+EMBEDDING_COMPACTION_THRESHOLD = 0.25
+
+# rewrites the embedding file without the embeddings of deleted faces
+# a slot that no row of photo_faces points to is dead, and stays in the file until this runs
+# returns the number of dead slots removed
+def compact_embeddings(threshold=EMBEDDING_COMPACTION_THRESHOLD):
+    with connection_manager.transaction() as cursor:
+        generation = _get_embedding_generation(cursor)
+        total = embedding_store.count(generation)
+        cursor.execute('SELECT DISTINCT slot FROM photo_faces ORDER BY slot')
+        live_slots = [row[0] for row in cursor.fetchall()]
+
+        # not worth rewriting the file if only a few slots are dead
+        dead = total - len(live_slots)
+        if dead <= 0 or dead < threshold * total:
+            return 0
+
+        # copy the live embeddings to a new file and point photo_faces at their new slots
+        # the file of the old generation is used until this transaction commits, so a crash leaves it untouched
+        embedding_store.write_compacted(generation, generation + 1, live_slots)
+        cursor.execute('CREATE TEMP TABLE slot_map (old_slot INTEGER PRIMARY KEY, new_slot INTEGER NOT NULL)')
+        cursor.executemany('INSERT INTO slot_map VALUES (?, ?)', [(slot, i) for i, slot in enumerate(live_slots)])
+        cursor.execute('UPDATE photo_faces SET slot = (SELECT new_slot FROM slot_map WHERE old_slot = photo_faces.slot)')
+        cursor.execute('DROP TABLE slot_map')
+        cursor.execute('UPDATE embedding_files SET generation = ?', (generation + 1,))
+
+    # let go of the old file, then delete it
+    _notify_photo_face_listeners()
+    embedding_store.remove_unused(generation + 1)
+
+    return dead
+
+# returns the faces the clustering job hasn't seen yet as (face_ids, slots)
+def get_unclustered_faces():
+    rows = connection_manager.fetch_all('SELECT id, slot FROM photo_faces WHERE cluster_id IS NULL ORDER BY id')
+
+    return [row[0] for row in rows], [row[1] for row in rows]
+
+# returns every cluster as a list of tuples (cluster_id, centroid_as_blob, size)
+def get_face_clusters():
+    return connection_manager.fetch_all('SELECT id, centroid, size FROM face_clusters ORDER BY id')
+
+# saves the result of a clustering run
+# clusters is a list of (cluster_id, centroid_as_blob, size) for every new or changed cluster
+# new clusters have a negative cluster_id that's replaced with a real one here, in the same transaction that adds them
+# so two clustering runs can never give different clusters the same id
+# assignments is a list of (cluster_id, face_id) for every face that was given a cluster, using the same ids as clusters
+# faces that join a cluster which already has a name are tagged with that name straight away
+def save_face_clusters(clusters, assignments):
+    with connection_manager.transaction() as cursor:
+        new_ids = {}
+        for cluster_id, centroid, size in clusters:
+            if cluster_id < 0:
+                cursor.execute('INSERT INTO face_clusters (centroid, size) VALUES (?, ?)', (centroid, size))
+                new_ids[cluster_id] = cursor.lastrowid
+            else:
+                cursor.execute('UPDATE face_clusters SET centroid = ?, size = ? WHERE id = ?', (centroid, size, cluster_id))
+        cursor.executemany('UPDATE photo_faces SET cluster_id = ? WHERE id = ?',
+                [(new_ids.get(cluster_id, cluster_id), face_id) for cluster_id, face_id in assignments])
+
+        # tag the photos of new faces in named clusters
+        face_ids = [face_id for _, face_id in assignments]
+        photo_ids = []
+        for chunk in _chunks(face_ids):
+            placeholders = ', '.join('?' * len(chunk))
+            cursor.execute(f'''INSERT OR IGNORE INTO photo_tags
+                    SELECT photo_faces.photo_id, tags.id FROM photo_faces
+                    JOIN face_clusters ON face_clusters.id = photo_faces.cluster_id
+                    JOIN tags ON tags.name = face_clusters.name
+                    WHERE photo_faces.id IN ({placeholders})''', chunk)
+            if cursor.rowcount > 0:
+                cursor.execute(f'''SELECT DISTINCT photo_faces.photo_id FROM photo_faces
+                        JOIN face_clusters ON face_clusters.id = photo_faces.cluster_id
+                        WHERE face_clusters.name IS NOT NULL AND photo_faces.id IN ({placeholders})''', chunk)
+                photo_ids += [row[0] for row in cursor.fetchall()]
+        _refresh_search_index(cursor, photo_ids)
+
+# returns the cluster of the face in the photo whose embedding is in slot, or None if it hasn't been clustered
+def get_face_cluster(filepath, slot):
+    data = connection_manager.fetch_one('''SELECT photo_faces.cluster_id FROM photo_faces
+            JOIN photos ON photos.id = photo_faces.photo_id WHERE photos.filepath = ? AND photo_faces.slot = ?''', (filepath, slot))
+
+    return data[0] if data else None
+
+# returns the slots of the embeddings of every face in a photo
+def get_photo_face_slots(filepath):
+    rows = connection_manager.fetch_all('''SELECT photo_faces.slot FROM photo_faces
+            JOIN photos ON photos.id = photo_faces.photo_id WHERE photos.filepath = ?''', (filepath,))
+
+    return [row[0] for row in rows]
+
+# returns the faces stored for a photo when it was processed as a list of tuples (slot, bbox, det_score, thumbnail)
+# the embedding of each face is row slot of the embedding file
+# returns None if the photo was processed before faces were stored, since its faces have to be detected again
+def get_stored_faces(filepath):
+    data = connection_manager.fetch_one('SELECT id, faces_indexed FROM photos WHERE filepath = ?', (filepath,))
+    if not data or not data[1]:
+        return None
+
+    rows = connection_manager.fetch_all('''SELECT slot, x1, y1, x2, y2, det_score, thumbnail FROM photo_faces
+            WHERE photo_id = ? ORDER BY id''', (data[0],))
+
+    return [(row[0], row[1:5], row[5], row[6]) for row in rows]
+
+# names a cluster and tags every photo with a face in it, all in one statement
+# returns the number of photos that were tagged
+def name_face_cluster(cluster_id, tag_name):
+    with connection_manager.transaction() as cursor:
+        cursor.execute('UPDATE face_clusters SET name = ? WHERE id = ?', (tag_name, cluster_id))
+        cursor.execute('INSERT OR IGNORE INTO tags (name) VALUES (?)', (tag_name,))
+        cursor.execute('''INSERT OR IGNORE INTO photo_tags
+                SELECT DISTINCT photo_id, (SELECT id FROM tags WHERE name = ?) FROM photo_faces WHERE cluster_id = ?''',
+                (tag_name, cluster_id))
+        tagged = cursor.rowcount
+
+        cursor.execute('SELECT DISTINCT photo_id FROM photo_faces WHERE cluster_id = ?', (cluster_id,))
+        _refresh_search_index(cursor, [row[0] for row in cursor.fetchall()])
+
+    return tagged
 
 # returns a list of faces (name and embedding) from the database
 def get_faces():
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM faces')
-    faces = cursor.fetchall()
+    return connection_manager.fetch_all('SELECT * FROM faces')
 
-    # close the connection to the database
-    conn.close()
+# functions that run after a saved face changes, called with (name, embedding_as_blob, prev_name)
+# if every face was removed (when the database is reset), they're called with (None, None, None) instead
+face_listeners = []
 
-    return faces
+# runs callback every time a face is saved or the faces are reset
+def add_face_listener(callback):
+    face_listeners.append(callback)
+
+def _notify_face_listeners(name, embedding_as_blob, prev_name):
+    for listener in face_listeners:
+        listener(name, embedding_as_blob, prev_name)
 
 # add a name and embedding to the database
 def add_face_to_database(name, embedding_as_blob, prev_name):
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
-    # delete the data of the old name if exists
-    if prev_name:
-        cursor.execute('DELETE FROM faces WHERE name = (?)', (prev_name,))
-        cursor.execute('DELETE FROM photo_tags WHERE tag_name = (?)', (prev_name.lower(),))
+    with connection_manager.transaction() as cursor:
+        # the photos whose face names are changing, so their full-text index rows can be updated
+        changed_photo_ids = set(_get_photo_ids_with_tag(cursor, name.lower()))
+
+        # delete the data of the old name if exists
+        if prev_name:
+            changed_photo_ids.update(_get_photo_ids_with_tag(cursor, prev_name.lower()))
+            cursor.execute('DELETE FROM faces WHERE name = (?)', (prev_name,))
+            cursor.execute('DELETE FROM photo_tags WHERE tag_id = (SELECT id FROM tags WHERE name = ?)', (prev_name.lower(),))
 
-    # add the name and embedding to the database
-    cursor.execute('INSERT OR REPLACE INTO faces VALUES (?, ?)', (name, embedding_as_blob))
+        # add the name and embedding to the database
+        cursor.execute('INSERT OR REPLACE INTO faces VALUES (?, ?)', (name, embedding_as_blob))
 
-    # commit changes and close the connection
-    conn.commit()
-    conn.close()
+        _refresh_search_index(cursor, changed_photo_ids)
+
+    # let anything that keeps the faces in memory know about the change
+    _notify_face_listeners(name, embedding_as_blob, prev_name)
 
 def get_folders():
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
     # get all the folders
-    cursor.execute('SELECT * FROM folders')
-    folders = cursor.fetchall()
+    folders = connection_manager.fetch_all('SELECT * FROM folders')
 
     # each entry is a tuple so it needs to be converted to string
     folders = [folder[0] for folder in folders]
 
-    # close the connection to the database
-    conn.close()
-
     return folders
 
+# returns the added folder that a path is in, or None if it isn't in one
+def get_folder_of(path, folders):
+    for folder_path in folders:
+        if path == folder_path or path.startswith(os.path.join(folder_path, '')):
+            return folder_path
+
+    return None
+
+# returns True if the files under a path can be looked at
+# a folder on a drive that was unplugged or a network share that went offline looks the same as a folder whose files were deleted
+# so files are only counted as deleted when the added folder they're in is still there
+# a file that isn't in an added folder (e.g. one processed from the command line) is checked by the folder it's in
+# folders is the list of added folders, which is read from the database when it isn't given
+def is_available(path, folders=None):
+    if folders is None:
+        folders = get_folders()
+    folder_path = get_folder_of(path, folders)
+    return os.path.isdir(folder_path if folder_path is not None else os.path.dirname(path))
+
 # add a folder path to the database
 def add_folder(folder_path):
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
-    # add the path to the database
-    cursor.execute('INSERT OR IGNORE INTO folders VALUES (?)', (folder_path,))
-
-    # commit changes and close the connection
-    conn.commit()
-    conn.close()
+    with connection_manager.transaction() as cursor:
+        # add the path to the database
+        cursor.execute('INSERT OR IGNORE INTO folders VALUES (?)', (folder_path,))
 
 # remove a folder from the database
 def remove_folder(folder_path):
     print(folder_path)
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
-    # delete the folder path from the folders table
-    cursor.execute('DELETE FROM folders WHERE folder_path = (?)', (folder_path,))
-
-    # delete all photos with that folder path from the photos table
-    cursor.execute('DELETE FROM photos WHERE folder_path = (?)', (folder_path,))
-
-    # commit changes and close the connection
-    conn.commit()
-    conn.close()
+    with connection_manager.transaction() as cursor:
+        # delete the folder path from the folders table
+        cursor.execute('DELETE FROM folders WHERE folder_path = (?)', (folder_path,))
+
+        # delete all photos in that folder and the folders inside it from the photos table
+        # their tags, faces and full-text index rows are deleted along with them
+        subfolder_prefix = os.path.join(folder_path, '')
+        cursor.execute('DELETE FROM photos WHERE folder_path = ? OR substr(folder_path, 1, length(?)) = ?',
+                (folder_path, subfolder_prefix, subfolder_prefix))
+
+    _notify_photo_face_listeners()
+
+# yields (id, filepath) for every photo in the database
+def iter_photo_filepaths():
+    yield from connection_manager.get_connection().execute('SELECT id, filepath FROM photos')
+
+# removes photos from the database by id, along with their tags and faces
+def delete_photos(photo_ids):
+    with connection_manager.transaction() as cursor:
+        for chunk in _chunks(list(photo_ids)):
+            cursor.execute(f'DELETE FROM photos WHERE id IN ({", ".join("?" * len(chunk))})', chunk)
+
+    _notify_photo_face_listeners()
+
+# removes photos from the database by filepath, along with their tags and faces
+# returns the number of photos removed, filepaths that aren't in the database are ignored
+def delete_photos_by_filepath(filepaths):
+    removed = 0
+    with connection_manager.transaction() as cursor:
+        for chunk in _chunks(list(filepaths)):
+            cursor.execute(f'DELETE FROM photos WHERE filepath IN ({", ".join("?" * len(chunk))})', chunk)
+            removed += cursor.rowcount
+
+    _notify_photo_face_listeners()
+
+    return removed
+
+# returns {filepath: (size, mtime)} for every photo in a folder and the folders inside it
+# the fingerprints are (None, None) for photos processed before fingerprints were stored
+def get_folder_fingerprints(folder_path):
+    subfolder_prefix = os.path.join(folder_path, '')
+    rows = connection_manager.fetch_all('''SELECT filepath, size, mtime FROM photos
+            WHERE folder_path = ? OR substr(folder_path, 1, length(?)) = ?''', (folder_path, subfolder_prefix, subfolder_prefix))
+
+    return {filepath: (size, mtime) for filepath, size, mtime in rows}
+
+# deletes rows that point to photos which aren't in the database anymore, and tags that nothing uses
+# returns a dictionary of how many rows were deleted from each table
+def remove_orphans():
+    removed = {}
+
+    with connection_manager.transaction() as cursor:
+        cursor.execute('DELETE FROM photo_tags WHERE photo_id NOT IN (SELECT id FROM photos)')
+        removed['photo_tags'] = cursor.rowcount
+        cursor.execute('DELETE FROM photo_faces WHERE photo_id NOT IN (SELECT id FROM photos)')
+        removed['photo_faces'] = cursor.rowcount
+        cursor.execute('DELETE FROM photo_search WHERE rowid NOT IN (SELECT id FROM photos)')
+        removed['photo_search'] = cursor.rowcount
+        # tags with no photos that aren't the names of saved faces won't come back on their own
+        cursor.execute('DELETE FROM tags WHERE photo_count <= 0 AND name NOT IN (SELECT lower(name) FROM faces)')
+        removed['tags'] = cursor.rowcount
+
+    _notify_photo_face_listeners()
+
+    return removed
+
+# returns the number of bytes the database takes up on disk, including its write-ahead log and embedding file
+def get_database_size():
+    size = 0
+    paths = [connection_manager.DATABASE_PATH, connection_manager.DATABASE_PATH + '-wal', embedding_store.get_path(get_embedding_generation())]
+    for path in paths:
+        if os.path.exists(path):
+            size += os.path.getsize(path)
+
+    return size
+
+# gives the space left by deleted rows back to the file system and updates the query planner's statistics
+# can't be run inside a transaction
+def compact_database():
+    conn = connection_manager.get_connection()
+
+    # databases made before auto_vacuum was turned on need one full VACUUM to switch to incremental mode
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    else:
+        # each step of this pragma frees one page and execute only runs the first step
+        # executescript runs it until every free page has been given back
+        conn.executescript('PRAGMA incremental_vacuum')
+
+    # recalculate the statistics SQLite uses to choose indexes
+    conn.execute('ANALYZE')
+    # merge the full-text index into as few pieces as possible
+    conn.execute("INSERT INTO photo_search (photo_search) VALUES ('optimize')")
+    # copy the write-ahead log into the database and shrink it back to nothing
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+# the type of each column in the settings table
+# values are converted to these types when they're loaded or changed
+SETTING_TYPES = {
+    'use_metadata': bool,
+    'reprocess_images': bool,
+    'max_photos': int,
+    'last_opened_dir': str,
+}
+
+# keeps a copy of the settings table in memory
+# reads never touch the database, and changes are written through to the settings table straight away
+class Settings:
+    def __init__(self):
+        # maps the name of each setting to its value, None until the settings are loaded
+        self.values = None
+        # functions that run when a setting changes, called with (name, value)
+        self.listeners = []
+
+    # reads the settings table into memory
+    def load(self):
+        names = list(SETTING_TYPES)
+        data = connection_manager.fetch_one(f'SELECT {", ".join(names)} FROM settings WHERE id = 1')
+        self.values = {name: self.convert(name, value) for name, value in zip(names, data)}
+
+    # converts a value to the type of the setting, leaving None as it is
+    def convert(self, name, value):
+        return value if value is None else SETTING_TYPES[name](value)
+
+    def get(self, name):
+        # load the settings the first time they're used
+        if self.values is None:
+            self.load()
+
+        return self.values[name]
+
+    def set(self, name, value):
+        value = self.convert(name, value)
+        # nothing to do if the setting isn't changing
+        if self.get(name) == value:
+            return
+
+        # write the change to the database first so memory never holds a value that wasn't saved
+        with connection_manager.transaction() as cursor:
+            cursor.execute(f'UPDATE settings SET {name} = ? WHERE id = 1', (value,))
+        self.values[name] = value
+
+        for listener in self.listeners:
+            listener(name, value)
+
+    # runs callback(name, value) every time a setting changes
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+# the settings of the application, loaded once by init_database
+settings = Settings()
 
 # the rest of these are just various getters and setters
 def get_use_metadata():
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM settings')
-    data = cursor.fetchone()
-
-    # close the connection to the database
-    conn.close()
-
-    return bool(data[1])
+    return settings.get('use_metadata')
 
 def set_use_metadata(use_metadata):
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('UPDATE settings SET use_metadata = ? WHERE id = 1', (use_metadata,))
-
-    conn.commit()
-    conn.close()
+    settings.set('use_metadata', use_metadata)
 
 def get_reprocess_images():
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM settings')
-    data = cursor.fetchone()
-
-    # close the connection to the database
-    conn.close()
-
-    return bool(data[2])
+    return settings.get('reprocess_images')
 
 def set_reprocess_images(reprocess_images):
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('UPDATE settings SET reprocess_images = ? WHERE id = 1', (reprocess_images,))
-
-    conn.commit()
-    conn.close()
+    settings.set('reprocess_images', reprocess_images)
 
 def get_max_photos():
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM settings')
-    data = cursor.fetchone()
-
-    # close the connection to the database
-    conn.close()
-
-    return data[3]
+    return settings.get('max_photos')
 
 def set_max_photos(max_photos):
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('UPDATE settings SET max_photos = ? WHERE id = 1', (max_photos,))
-
-    conn.commit()
-    conn.close()
+    settings.set('max_photos', max_photos)
 
 def get_last_opened_dir():
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM settings')
-    data = cursor.fetchone()
-
-    # close the connection to the database
-    conn.close()
-
-    return data[4]
+    return settings.get('last_opened_dir')
 
 def set_last_opened_dir(last_opened_dir):
-    # connect to the database
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('UPDATE settings SET last_opened_dir = ? WHERE id = 1', (last_opened_dir,))
-
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    settings.set('last_opened_dir', last_opened_dir)
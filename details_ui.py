@@ -48,13 +48,13 @@ class DetailsUI:
         # show the location and timestamp if they exist
         self.filepath_label = tk.Label(self.details_window, text=f'Filepath: {self.filepath}')
         self.filepath_label.pack()
-        location, timestamp = database_manager.get_photo(self.filepath)
-        if(location):
-            readable_location = text_processing.location_to_readable(location)
+        latitude, longitude, taken_at = database_manager.get_photo(self.filepath)
+        if(latitude is not None and longitude is not None):
+            readable_location = text_processing.location_to_readable(latitude, longitude)
             self.location_label = tk.Label(self.details_window, text=f'Location that the image was taken: {readable_location}')
             self.location_label.pack()
-        if(timestamp):
-            readable_timestamp = text_processing.timestamp_to_readable(timestamp)
+        if(taken_at is not None):
+            readable_timestamp = text_processing.timestamp_to_readable(taken_at)
             self.timestamp_label = tk.Label(self.details_window, text=f'Date the image was taken: {readable_timestamp}')
             self.timestamp_label.pack()
         
@@ -83,29 +83,36 @@ class DetailsUI:
             database_manager.add_face_to_database(name, face_processing.embedding_to_blob(widget.embedding), widget.name)
             
             # add the tag for that face to images that contain it
-            photos_with_face = []
-            photos = database_manager.get_all_photos()
-            for photo_data in photos:
-                filepath, folder_path, location, timestamp, tags, faces = photo_data
-                face_embeddings = [face_processing.blob_to_embedding(blob) for blob in faces]
-                face_labels = face_processing.label_faces(face_embeddings)
-                if name in face_labels:
-                    photos_with_face.append(filepath)
-            
-            for filepath in photos_with_face:
-                database_manager.add_tag_to_photo(filepath, name.lower())
+            # if the face has been clustered, every photo in its cluster is tagged at once
+            # faces loaded from the database already know which stored face they are
+            if widget.slot is not None:
+                cluster_id = database_manager.get_face_cluster(self.filepath, widget.slot)
+            else:
+                cluster_id = face_processing.find_face_cluster(self.filepath, widget.embedding)
+            if cluster_id is not None:
+                database_manager.name_face_cluster(cluster_id, name.lower())
+            else:
+                # otherwise every face in every photo is compared to this one at once
+                photos_with_face = face_processing.find_photos_with_face(widget.embedding)
+                database_manager.add_tag_to_photos(photos_with_face, name.lower())
 
             widget.config(text=name)
             widget.name = name
 
     # show the faces in the image
     def find_faces(self):
-        # detect the faces
-        cv_image, faces = face_processing.detect_image(self.filepath)
-        # get Pillow images of each face
-        face_thumbnails = face_processing.get_face_thumbnails(cv_image, faces)
+        # use the faces that were stored when the photo was processed
+        stored_faces = face_processing.get_stored_faces(self.filepath)
+        if stored_faces is not None:
+            face_thumbnails, face_embeddings, face_slots = stored_faces
+        else:
+            # the photo was processed before faces were stored, so detect them again
+            cv_image, faces = face_processing.detect_image(self.filepath)
+            # get Pillow images of each face
+            face_thumbnails = face_processing.get_face_thumbnails(cv_image, faces)
+            face_embeddings = [face.normed_embedding for face in faces]
+            face_slots = [None] * len(faces)
         # label the faces if a match exists in the database
-        face_embeddings = [face.normed_embedding for face in faces]
         face_labels = face_processing.label_faces(face_embeddings)
         
         # for each face, create a label which holds its image and name
@@ -116,7 +123,8 @@ class DetailsUI:
             # store tk_image in the label
             # without this line, the image gets garbage collected and fails to display
             container_label.image = tk_image
-            container_label.embedding = faces[index].normed_embedding
+            container_label.embedding = face_embeddings[index]
+            container_label.slot = face_slots[index]
             container_label.name = face_name
             container_label.pack(padx=5, pady=5, side=tk.LEFT)
             # when the user clicks the image, run ask_save_face
@@ -0,0 +1,117 @@
+# stores the embedding of every face found in a photo in one file of raw float32 values
+# row i of the file is the embedding in slot i, and the photo_faces table says which photo each slot belongs to
+# the file is memory-mapped, so searching it reads the embeddings straight from the file with no copying
+# and the operating system only loads the parts that are used
+import numpy as np
+
+import os
+import glob
+import threading
+
+import connection_manager
+
+# the number of values in each embedding made by the buffalo_l model
+EMBEDDING_SIZE = 512
+# the number of bytes in each row of the file
+ROW_BYTES = EMBEDDING_SIZE * np.dtype(np.float32).itemsize
+
+# stops two threads from appending to the file at the same time
+_append_lock = threading.Lock()
+
+# the most recently opened memory map, reused until the file changes
+# a tuple (path, number of rows, matrix)
+_matrix_cache = None
+
+# the file is never changed in place, compacting it writes a new file with the next generation number
+# the database stores which generation is current, so the file and the slots in the database always agree
+def get_path(generation):
+    folder = os.path.dirname(connection_manager.DATABASE_PATH)
+    return os.path.join(folder, f'embeddings.{generation}.f32')
+
+# returns the number of slots in the file
+def count(generation):
+    path = get_path(generation)
+    return os.path.getsize(path) // ROW_BYTES if os.path.exists(path) else 0
+
+# scales each embedding to length 1 and stacks them into a matrix
+# every row in the file is normalized, so the dot product of a row and a normalized query is their cosine similarity
+def _normalize(embeddings):
+    matrix = np.asarray(embeddings, dtype=np.float32).reshape(-1, EMBEDDING_SIZE)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+
+    return matrix / norms
+
+# turns embeddings stored as bytes (the way they were stored in the database) into a matrix
+def blobs_to_matrix(blobs):
+    return np.frombuffer(b''.join(blobs), dtype=np.float32).reshape(-1, EMBEDDING_SIZE)
+
+# adds embeddings to the end of the file and returns the slot of each one
+# slots that end up not being used by the database (e.g. if the transaction fails) are removed when the file is compacted
+def append(generation, embeddings):
+    if len(embeddings) == 0:
+        return []
+
+    matrix = _normalize(embeddings)
+
+    with _append_lock:
+        with open(get_path(generation), 'ab') as file:
+            # drop a half-written row left over from a crash so every row starts at a multiple of ROW_BYTES
+            # only truncated when there is one, since Windows can't resize a file while it's memory-mapped
+            first_slot = file.tell() // ROW_BYTES
+            if file.tell() % ROW_BYTES != 0:
+                file.truncate(first_slot * ROW_BYTES)
+                file.seek(first_slot * ROW_BYTES)
+
+            file.write(matrix.tobytes())
+            # make sure the embeddings are on disk before the database commits slots that point to them
+            file.flush()
+            os.fsync(file.fileno())
+
+    return list(range(first_slot, first_slot + len(matrix)))
+
+# returns a read-only matrix of every slot in the file, backed by the file itself
+def open_matrix(generation):
+    global _matrix_cache
+
+    path = get_path(generation)
+    rows = count(generation)
+
+    # an empty file can't be memory-mapped
+    if rows == 0:
+        return np.zeros((0, EMBEDDING_SIZE), dtype=np.float32)
+
+    # map the file again if it's a different generation or embeddings were appended
+    if _matrix_cache is None or _matrix_cache[:2] != (path, rows):
+        _matrix_cache = (path, rows, np.memmap(path, dtype=np.float32, mode='r', shape=(rows, EMBEDDING_SIZE)))
+
+    return _matrix_cache[2]
+
+# writes the embeddings in slots (in that order) to the file of new_generation
+# slot slots[i] of the old file becomes slot i of the new one
+def write_compacted(old_generation, new_generation, slots, chunk_size=16384):
+    old_matrix = open_matrix(old_generation)
+    slots = np.asarray(slots, dtype=np.int64)
+
+    with open(get_path(new_generation), 'wb') as file:
+        # copy a chunk at a time so the whole file never has to be in memory
+        for start in range(0, len(slots), chunk_size):
+            file.write(np.ascontiguousarray(old_matrix[slots[start:start + chunk_size]]).tobytes())
+        file.flush()
+        os.fsync(file.fileno())
+
+# deletes the files of every generation except keep_generation (or every file if it's None)
+# files that are still memory-mapped somewhere can't be deleted on Windows, so they're left for next time
+def remove_unused(keep_generation=None):
+    global _matrix_cache
+
+    keep_path = get_path(keep_generation) if keep_generation is not None else None
+    if _matrix_cache is not None and _matrix_cache[0] != keep_path:
+        _matrix_cache = None
+
+    for path in glob.glob(get_path('*')):
+        if path != keep_path:
+            try:
+                os.remove(path)
+            except OSError:
+                print(f'Could not remove {path}, it will be removed next time')
@@ -0,0 +1,108 @@
+# groups the faces found in photos into clusters that are likely to be the same person
+# so naming one face can tag every photo of that person at once
+# runs after processing a folder, or on its own with: python face_clustering.py
+import numpy as np
+
+import threading
+
+import database_manager
+import embedding_store
+
+# two faces are put in the same cluster if their similarity is above this
+# the same threshold that label_faces uses to decide two faces are the same person
+CLUSTER_THRESHOLD = 0.5
+
+# the number of new faces compared to the clusters at once
+CHUNK_SIZE = 1024
+
+# stops two threads from clustering the same faces at once
+_lock = threading.Lock()
+
+# scales each row of a matrix to length 1
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+
+    return matrix / norms
+
+# puts each face in the chunk into a cluster, adding new clusters when a face doesn't match any
+# returns the index of the cluster of each face, and the centroids and sizes with new clusters added to the end
+def _cluster_chunk(embeddings, centroids, sizes):
+    # compare every face in the chunk to every cluster at once
+    labels = np.full(len(embeddings), -1, dtype=np.int64)
+    if len(centroids) > 0:
+        similarities = embeddings @ centroids.T
+        best_clusters = similarities.argmax(axis=1)
+        matched = similarities[np.arange(len(embeddings)), best_clusters] > CLUSTER_THRESHOLD
+        labels[matched] = best_clusters[matched]
+
+    # the faces that didn't match an existing cluster are grouped with each other
+    # the first ungrouped face starts a new cluster and takes every other ungrouped face that's similar enough
+    unmatched = np.nonzero(labels == -1)[0]
+    if len(unmatched) > 0:
+        unmatched_similarities = embeddings[unmatched] @ embeddings[unmatched].T
+        remaining = np.ones(len(unmatched), dtype=bool)
+        new_centroids = []
+        for i in range(len(unmatched)):
+            if not remaining[i]:
+                continue
+            members = remaining & (unmatched_similarities[i] > CLUSTER_THRESHOLD)
+            remaining &= ~members
+            labels[unmatched[members]] = len(centroids) + len(new_centroids)
+            new_centroids.append(np.zeros(embedding_store.EMBEDDING_SIZE, dtype=np.float32))
+
+        centroids = np.concatenate([centroids, np.array(new_centroids, dtype=np.float32).reshape(-1, embedding_store.EMBEDDING_SIZE)])
+        sizes = np.concatenate([sizes, np.zeros(len(new_centroids), dtype=np.int64)])
+
+    # move each centroid to the average of all of its faces, old and new
+    sums = centroids * sizes[:, None]
+    np.add.at(sums, labels, embeddings)
+    sizes = sizes + np.bincount(labels, minlength=len(sizes))
+    centroids = _normalize(sums).astype(np.float32)
+
+    return labels, centroids, sizes
+
+# clusters every face that hasn't been clustered yet
+# faces that were clustered before are never looked at again, so this only costs as much as the number of new faces
+# returns the number of faces that were clustered
+def cluster_new_faces():
+    with _lock:
+        return _cluster_new_faces()
+
+def _cluster_new_faces():
+    face_ids, slots = database_manager.get_unclustered_faces()
+    if not face_ids:
+        return 0
+
+    # load the existing clusters
+    clusters = database_manager.get_face_clusters()
+    cluster_ids = [cluster_id for cluster_id, _, _ in clusters]
+    centroids = embedding_store.blobs_to_matrix([centroid for _, centroid, _ in clusters]).astype(np.float32)
+    sizes = np.array([size for _, _, size in clusters], dtype=np.int64)
+    old_sizes = sizes.copy()
+
+    matrix = embedding_store.open_matrix(database_manager.get_embedding_generation())
+    slots = np.array(slots, dtype=np.int64)
+    labels = np.empty(len(face_ids), dtype=np.int64)
+
+    for start in range(0, len(face_ids), CHUNK_SIZE):
+        embeddings = np.asarray(matrix[slots[start:start + CHUNK_SIZE]], dtype=np.float32)
+        labels[start:start + CHUNK_SIZE], centroids, sizes = _cluster_chunk(embeddings, centroids, sizes)
+
+    # new clusters get negative ids until the database gives them real ones when they're saved
+    cluster_ids += list(range(-1, -(len(sizes) - len(cluster_ids)) - 1, -1))
+
+    # only save the clusters that gained faces
+    changed = np.nonzero(sizes != np.concatenate([old_sizes, np.zeros(len(sizes) - len(old_sizes), dtype=np.int64)]))[0]
+    database_manager.save_face_clusters(
+        [(cluster_ids[i], centroids[i].tobytes(), int(sizes[i])) for i in changed],
+        [(cluster_ids[label], face_id) for label, face_id in zip(labels.tolist(), face_ids)])
+
+    return len(face_ids)
+
+def main():
+    database_manager.init_database()
+    print(f'Clustered {cluster_new_faces()} new faces')
+
+if __name__ == '__main__':
+    main()
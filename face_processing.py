@@ -5,41 +5,54 @@ print("cv2 version:", cv2.__version__)
 # numpy is used to calculate cosine similarity
 import numpy as np
 
-# InsightFace is the face processing AI
-import insightface
-from insightface.app import FaceAnalysis
+# InsightFace is the face processing AI, loaded the first time it's used by model_registry
+import model_registry
 
 from PIL import Image
 
 import re
+import io
 
 import database_manager
+import embedding_store
 
-# initialize the InsightFace model
-app = FaceAnalysis(name='buffalo_l')
-app.prepare(ctx_id=0, det_size=(640, 640))
+# the file extensions insightface can read, in lowercase
+VALID_EXTENSIONS = {'webp', 'tif', 'tiff', 'jpg', 'bmp', 'png', 'jpeg'}
 
 # validate the filepath to make sure it's compatible with InsightFace
 def validate_path(filepath):
-    # valid file extensions
-    valid_extensions = {'webp', 'tif', 'tiff', 'jpg', 'bmp', 'png', 'jpeg'}
-
     # get the file extension of the filepath
-    file_type = re.split(r'\.', filepath)[-1]
+    # extensions are compared in lowercase so files like IMG_0001.JPG are accepted too
+    file_type = re.split(r'\.', filepath)[-1].lower()
     
     # make sure the file extension is compatible with insightface
-    if file_type in valid_extensions:
+    if file_type in VALID_EXTENSIONS:
         return True
     
     return False
 
+# the number of values in each embedding made by the buffalo_l model
+EMBEDDING_SIZE = embedding_store.EMBEDDING_SIZE
+
+# the lowest similarity for two faces to be counted as the same person
+# similarity > 0.5 means the faces are very likely to be a match
+MATCH_THRESHOLD = 0.5
+
 # embeddings are multi-dimensional vectors
 # in linear algebra, the angle between two vectors v1 and v2 is
 # v1 • v2 / (||v1|| * ||v2||)
 # where • denotes the dot product and ||v|| is the magnitude of v
 # if the cosine is higher, the angles are closer together meaning the embeddings are more likely to be a match
-def cosine_similarity(embedding1, embedding2):
-    return np.dot(embedding1, embedding2) / (np.linalg.norm(embedding1) * np.linalg.norm(embedding2))
+# dividing every embedding by its magnitude first means the cosine is just the dot product,
+# so the similarity of every pair of faces can be found with one matrix multiplication
+def normalize_embeddings(embeddings):
+    # stack the embeddings into a matrix with one row per face
+    matrix = np.asarray(embeddings, dtype=np.float32).reshape(-1, EMBEDDING_SIZE)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    # leave empty embeddings as zeros instead of dividing by zero
+    norms[norms == 0] = 1
+
+    return matrix / norms
 
 # runs InsightFace on an image to get a list of face data
 def detect_image(filepath):
@@ -47,20 +60,57 @@ def detect_image(filepath):
     image = cv2.imread(filepath)
     # continue if the file type is valid
     if validate_path(filepath):
-        faces = app.get(image)
-    
-        return image, faces or []
+        return image, detect_faces(image)
     else:
         print('This file is not supported by InsightFace')
         return image, []
 
+# runs InsightFace on an image that has already been decoded to a BGR numpy array
+def detect_faces(image):
+    return detect_faces_batch([image])[0]
+
+# runs InsightFace on a list of BGR numpy arrays and returns a list of faces for each one, in the same order
+# InsightFace can only look for faces in one image at a time, but the embeddings of every face found
+# in every image are made in one call to the recognition model instead of one call per face
+# the other models in the pack (age, gender and landmarks) aren't run since nothing uses them
+def detect_faces_batch(images):
+    # imported here so importing this file doesn't import insightface (see model_registry)
+    from insightface.app.common import Face
+    from insightface.utils import face_align
+
+    app = model_registry.get_face_app()
+    recognition_model = app.models['recognition']
+
+    # find the faces in each image
+    image_faces = []
+    crops = []
+    for image in images:
+        bboxes, keypoints = app.det_model.detect(image, max_num=0, metric='default')
+        faces = []
+        for i in range(bboxes.shape[0]):
+            face = Face(bbox=bboxes[i, 0:4], kps=keypoints[i] if keypoints is not None else None, det_score=bboxes[i, 4])
+            # line the face up the way the recognition model expects, using the eyes, nose and mouth
+            crops.append(face_align.norm_crop(image, landmark=face.kps, image_size=recognition_model.input_size[0]))
+            faces.append(face)
+        image_faces.append(faces)
+
+    # make the embedding of every face at once
+    if crops:
+        embeddings = recognition_model.get_feat(crops)
+        all_faces = [face for faces in image_faces for face in faces]
+        for face, embedding in zip(all_faces, embeddings):
+            face.embedding = embedding.flatten()
+
+    return image_faces
+
 # get a list of Pillow images of each face detected
 def get_face_thumbnails(image, faces):
     face_thumbnails = []
 
     for face in faces:
         # bbox is the bounding box, this gets the location of the corners of the rectangle that contains the face
-        x1, y1, x2, y2 = face.bbox.astype(int)
+        # faces at the edge of the image can have corners outside it, which would crop the wrong part
+        x1, y1, x2, y2 = np.maximum(face.bbox.astype(int), 0)
         # crop the cv2 image to isolate the face
         cropped_face = image[y1:y2, x1:x2]
         # recolor it since cv2 uses BGR and Pillow uses RGB
@@ -73,36 +123,158 @@ def get_face_thumbnails(image, faces):
     
     return face_thumbnails
 
+# the quality of the JPEG face thumbnails stored in the database
+THUMBNAIL_QUALITY = 85
+
+# convert a face thumbnail to JPEG bytes that can be stored in the database
+def thumbnail_to_bytes(thumbnail):
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, format='JPEG', quality=THUMBNAIL_QUALITY)
+    return buffer.getvalue()
+
+# convert a thumbnail from the database back to a Pillow image
+# the inverse of thumbnail_to_bytes
+def bytes_to_thumbnail(data):
+    return Image.open(io.BytesIO(data))
+
+# get the data stored in the database for each face detected in an image
+# each entry is a tuple (embedding, bbox, det_score, thumbnail_as_bytes)
+def get_face_records(image, faces):
+    face_thumbnails = get_face_thumbnails(image, faces)
+
+    return [(face.normed_embedding, tuple(face.bbox.tolist()), float(face.det_score), thumbnail_to_bytes(thumbnail))
+            for face, thumbnail in zip(faces, face_thumbnails)]
+
+# get the faces stored for a photo when it was processed as (thumbnails, embeddings, slots)
+# returns None if they weren't stored, so the faces have to be detected again with detect_image
+def get_stored_faces(filepath):
+    stored_faces = database_manager.get_stored_faces(filepath)
+    if stored_faces is None or any(thumbnail is None for _, _, _, thumbnail in stored_faces):
+        return None
+
+    matrix = embedding_store.open_matrix(database_manager.get_embedding_generation())
+    thumbnails = [bytes_to_thumbnail(thumbnail) for _, _, _, thumbnail in stored_faces]
+    slots = [slot for slot, _, _, _ in stored_faces]
+    embeddings = [np.asarray(matrix[slot]) for slot in slots]
+
+    return thumbnails, embeddings, slots
+
+# the saved faces kept in memory so labelling faces doesn't have to read the database
+# a tuple (names, matrix) where row i of matrix is the normalized embedding of names[i]
+# None until it's first needed, and replaced as a whole when a face changes so it's never half updated
+known_faces = None
+
+# returns the saved faces as (names, matrix), reading them from the database the first time
+def get_known_faces():
+    global known_faces
+
+    if known_faces is None:
+        # get each face from the database and convert them back to vectors
+        saved_faces = database_manager.get_faces()
+        names = np.array([name for name, _ in saved_faces], dtype=object)
+        matrix = normalize_embeddings([blob_to_embedding(embedding) for _, embedding in saved_faces])
+        known_faces = (names, matrix)
+
+    return known_faces
+
+# keeps known_faces the same as the faces table
+# runs every time database_manager saves a face
+def update_known_faces(name, embedding_as_blob, prev_name):
+    global known_faces
+
+    # nothing to update if the faces haven't been loaded yet
+    if known_faces is None:
+        return
+
+    # all the faces were removed, so load them again next time they're needed
+    if name is None:
+        known_faces = None
+        return
+
+    # remove the rows of the old name and of the name being replaced, then add the new face at the end
+    names, matrix = known_faces
+    keep = (names != name) & (names != prev_name)
+    names = np.append(names[keep], np.array([name], dtype=object))
+    matrix = np.concatenate([matrix[keep], normalize_embeddings([blob_to_embedding(embedding_as_blob)])])
+    known_faces = (names, matrix)
+
+database_manager.add_face_listener(update_known_faces)
+
 # get a list of names that correspond to each face
+# it's important that the list has an entry for every face so each label corresponds to the correct face
+# if faces = [embedding1, embedding2, embedding3] and face_labels = ["Alice", None, "Bob"]
+# then embedding1 has the name Alice and embedding3 has the name Bob while embedding2 has not been labelled yet by the user
 def label_faces(face_embeddings):
-    face_labels = []
-    # get each face from the database
-    saved_faces = database_manager.get_faces()
-    # convert them back to vectors
-    saved_faces = [(name, blob_to_embedding(embedding)) for name, embedding in saved_faces]
-
-    # iterate through the faces detected in the image in the details ui
-    for embedding1 in face_embeddings:
-        # boolean to keep track of if the face has a name or not
-        match_found = False
-
-        # iterate through the faces saved on the database
-        for face2 in saved_faces:
-            name, embedding2 = face2
-            # get the similiarity between the two embeddings
-            similarity = cosine_similarity(embedding1, embedding2)
-            # similarity > 0.5 means the faces are very likely to be a match
-            if similarity > 0.5:
-                face_labels.append(name)
-                match_found = True
-
-        # it's important to add None to the list so each label corresponds to the correct face
-        # if faces = [embedding1, embedding2, embedding3] and face_labels = ["Alice", None, "Bob"]
-        # then embedding1 has the name Alice and embedding3 has the name Bob while embedding2 has not been labelled yet by the user
-        if not match_found:
-            face_labels.append(None)
-    
-    return face_labels     
+    if len(face_embeddings) == 0:
+        return []
+
+    # the saved faces come from memory, not the database
+    names, saved_matrix = get_known_faces()
+    if len(names) == 0:
+        return [None] * len(face_embeddings)
+
+    # the similarity between every face in the image (rows) and every saved face (columns)
+    similarities = normalize_embeddings(face_embeddings) @ saved_matrix.T
+
+    # each face gets the name of the saved face it's most similar to, if it's similar enough
+    best_matches = similarities.argmax(axis=1)
+    best_similarities = similarities[np.arange(len(best_matches)), best_matches]
+    face_labels = np.where(best_similarities > MATCH_THRESHOLD, names[best_matches], None)
+
+    return face_labels.tolist()
+
+# every face found in a photo kept in memory for reverse face search
+# a tuple (filepaths, slots, matrix) where the face in the photo filepaths[i] has its embedding in row slots[i] of matrix
+# matrix is memory-mapped from the embedding file, so it isn't copied into memory
+# None until it's first needed, and cleared whenever faces are added to or removed from photos
+photo_faces = None
+
+# returns the faces in photos as (filepaths, slots, matrix), reading them from the database if they've changed
+def get_photo_faces():
+    global photo_faces
+
+    if photo_faces is None:
+        filepaths, slots, matrix = database_manager.get_photo_face_embeddings()
+        photo_faces = (np.array(filepaths, dtype=object), np.array(slots, dtype=np.int64), matrix)
+
+    return photo_faces
+
+# throws away the faces in photos so they're read again next time
+def clear_photo_faces():
+    global photo_faces
+    photo_faces = None
+
+database_manager.add_photo_face_listener(clear_photo_faces)
+
+# returns the filepaths of every photo with a face that matches the embedding, most similar first
+def find_photos_with_face(embedding, threshold=MATCH_THRESHOLD):
+    filepaths, slots, matrix = get_photo_faces()
+
+    # the similarity between the embedding and every row of the embedding file
+    # the rows are already normalized, so this is one matrix-vector product straight over the file
+    similarities = (matrix @ normalize_embeddings([embedding])[0])[slots]
+
+    # the faces that match, sorted from most to least similar
+    matches = np.nonzero(similarities > threshold)[0]
+    matches = matches[np.argsort(-similarities[matches])]
+
+    # a photo can have more than one matching face, so only keep the first (most similar) one
+    return list(dict.fromkeys(filepaths[matches].tolist()))
+
+# returns the cluster of the stored face in a photo that matches the embedding, or None if there isn't one
+# used to connect a face detected in the details window to the face that was stored when the photo was processed
+def find_face_cluster(filepath, embedding):
+    slots = database_manager.get_photo_face_slots(filepath)
+    if not slots:
+        return None
+
+    matrix = embedding_store.open_matrix(database_manager.get_embedding_generation())
+    similarities = matrix[slots] @ normalize_embeddings([embedding])[0]
+    best_match = similarities.argmax()
+    if similarities[best_match] <= MATCH_THRESHOLD:
+        return None
+
+    return database_manager.get_face_cluster(filepath, slots[best_match])
 
 # convert an embedding (a tuple of floats) to bytes that can be stored in the database
 def embedding_to_blob(embedding):
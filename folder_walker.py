@@ -0,0 +1,69 @@
+# finds the image files in a folder and every folder inside it
+# files are yielded one at a time as they're found, so processing can start straight away
+# and memory use stays the same no matter how many files there are
+import fnmatch
+import os
+
+import image_processing
+import face_processing
+
+# the file extensions that can be processed, from YOLO and InsightFace
+VALID_EXTENSIONS = image_processing.VALID_EXTENSIONS | face_processing.VALID_EXTENSIONS
+
+# returns True if the name or the path relative to the folder being walked matches one of the patterns
+# patterns use shell wildcards, e.g. '*.png', 'raw/*' or 'thumbs'
+def _matches(name, relative_path, patterns):
+    relative_path = relative_path.replace(os.sep, '/')
+
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relative_path, pattern) for pattern in patterns)
+
+# yields the path of every image file in folder_path
+# include is a list of patterns that files have to match (all files if it's empty)
+# exclude is a list of patterns for files and folders to leave out, an excluded folder isn't looked inside at all
+# folders inside folder_path are searched too unless recursive is False
+# onerror is called with the OSError of every folder that couldn't be opened, like os.walk does
+# so callers can tell a folder that couldn't be read from one that's empty
+def walk_folder(folder_path, include=(), exclude=(), recursive=True, onerror=None):
+    # the folders still to be searched, used instead of recursion so very deep trees can't hit the recursion limit
+    # each entry is (path, path relative to folder_path)
+    folders = [(folder_path, '')]
+
+    while folders:
+        path, relative_folder = folders.pop()
+        try:
+            # scandir gets the type of each entry along with its name, so there's no extra stat call per file
+            entries = os.scandir(path)
+        except OSError as error:
+            print(f'Could not open {path}: {error}')
+            if onerror is not None:
+                onerror(error)
+            continue
+
+        subfolders = []
+        with entries:
+            for entry in entries:
+                relative_path = os.path.join(relative_folder, entry.name)
+                if exclude and _matches(entry.name, relative_path, exclude):
+                    continue
+
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subfolders.append((entry.path, relative_path))
+                        continue
+                    if not entry.is_file():
+                        continue
+                except OSError:
+                    continue
+
+                # get the file extension and make sure it can be processed
+                file_type = os.path.splitext(entry.name)[1][1:].lower()
+                if file_type not in VALID_EXTENSIONS:
+                    continue
+                if include and not _matches(entry.name, relative_path, include):
+                    continue
+
+                yield entry.path
+
+        # search the subfolders in the order they were found
+        if recursive:
+            folders += reversed(subfolders)
@@ -0,0 +1,287 @@
+# keeps the database up to date with the files in every added folder without processing whole folders again
+# a snapshot of the size and modification time of every image is compared with the files on disk,
+# new and changed files are sent to the ingest engine and photos whose files were deleted are removed
+# runs in the background of the app, or on its own with: python folder_watcher.py
+import threading
+import time
+import os
+
+import database_manager
+import ingest_engine
+import folder_walker
+
+# watchdog gets told about changes by the operating system (inotify on Linux, ReadDirectoryChangesW on Windows)
+# it's optional, without it every folder is scanned every POLL_INTERVAL seconds instead
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+# seconds between scans of every folder when watchdog isn't installed
+POLL_INTERVAL = 60
+# seconds between checks of the files watchdog said changed
+EVENT_INTERVAL = 2
+# seconds between full scans when watchdog is installed, in case it missed something (e.g. a network drive)
+RESCAN_INTERVAL = 3600
+
+# returns ({filepath: (size, mtime)} for every image in a folder and the folders inside it, [folders that couldn't be read])
+def scan_folder(folder_path):
+    snapshot = {}
+    unreadable = []
+    for filepath in folder_walker.walk_folder(folder_path, onerror=lambda error: unreadable.append(error.filename)):
+        stat = _stat(filepath)
+        if stat is not None:
+            snapshot[filepath] = stat
+
+    return snapshot, unreadable
+
+# returns (size, mtime) of a file in the same form as the fingerprints in the database, or None if it's gone
+def _stat(filepath):
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+
+    return (stat.st_size, stat.st_mtime_ns)
+
+# collects the paths watchdog reports so the watcher thread can check them
+class _ChangeHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        paths = [event.src_path, getattr(event, 'dest_path', None)]
+        with self.watcher.lock:
+            self.watcher.dirty.update(path for path in paths if path)
+
+class FolderWatcher:
+    def __init__(self, workers=1, poll_interval=POLL_INTERVAL):
+        self.poll_interval = poll_interval
+
+        # the size and modification time of every file the database is up to date with
+        self.snapshot = {}
+        # the folders being watched
+        self.folders = set()
+        # files that changed since they were last looked at, mapped to their size and modification time
+        # a file is only processed once it stops changing, so files that are still being copied aren't read half way
+        self.unsettled = {}
+        # files that were deleted, each group paired with the files that were new or changed in the same check
+        # a deleted file may have been moved to one of those, so its photo is only removed once they've been processed
+        # until then the ingest engine can still find the photo by its hash and move it instead of processing the file again
+        self.pending_deletes = []
+        # paths watchdog said changed, shared with its thread
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+        self.observer = None
+        self.watches = {}
+        self.last_full_scan = 0
+        self.stopped = threading.Event()
+        # one engine is used for every change, so its workers only load the models once instead of on every check
+        # workers is the number of worker processes it uses, few are needed since only the changes are processed
+        # it waits while another ingest is running (e.g. a folder being processed from the settings)
+        self.engine = ingest_engine.IngestEngine(workers=workers, keep_workers=True)
+
+    # starts watching in a background thread
+    def start(self):
+        if Observer is not None:
+            self.observer = Observer()
+            self.observer.start()
+
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+
+        return thread
+
+    def stop(self):
+        self.stopped.set()
+        self.engine.cancel()
+        if self.observer is not None:
+            self.observer.stop()
+
+    # checks for changes until stop is called
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.check()
+            except Exception as error:
+                print(f'Error while checking folders for changes: {error}')
+
+            self.stopped.wait(EVENT_INTERVAL if self.observer is not None else self.poll_interval)
+
+        # the workers are only kept while the watcher is running
+        self.engine.close()
+
+    # starts watching folders that were added and stops watching folders that were removed
+    def _update_folders(self):
+        folders = set(database_manager.get_folders())
+
+        for folder_path in self.folders - folders:
+            prefix = os.path.join(folder_path, '')
+            self.snapshot = {filepath: stat for filepath, stat in self.snapshot.items() if not filepath.startswith(prefix)}
+            if folder_path in self.watches:
+                self.observer.unschedule(self.watches.pop(folder_path))
+
+        new_folders = folders - self.folders
+        for folder_path in new_folders:
+            # start from what's in the database, so changes made while the app was closed are found too
+            self.snapshot.update(database_manager.get_folder_fingerprints(folder_path))
+
+        # folders that weren't available when they were added are watched once they are
+        if self.observer is not None:
+            for folder_path in folders - set(self.watches):
+                if os.path.isdir(folder_path):
+                    self.watches[folder_path] = self.observer.schedule(_ChangeHandler(self), folder_path, recursive=True)
+
+        self.folders = folders
+
+        return new_folders
+
+    # returns True if the files under a path can be looked at, see database_manager.is_available
+    def _is_available(self, path):
+        return database_manager.is_available(path, self.folders)
+
+    # compares part of the snapshot to the files on disk
+    # returns ({filepath: (size, mtime)} of new and changed files, [filepaths of deleted files])
+    def _compare_folder(self, folder_path):
+        if not self._is_available(folder_path):
+            return {}, []
+
+        current, unreadable = scan_folder(folder_path)
+        prefix = os.path.join(folder_path, '')
+        old = {filepath: stat for filepath, stat in self.snapshot.items() if filepath.startswith(prefix)}
+        # the files in folders that couldn't be read are left as they are until they can be
+        unreadable = tuple(os.path.join(path, '') for path in unreadable)
+
+        changed = {filepath: stat for filepath, stat in current.items() if old.get(filepath) != stat}
+        deleted = [filepath for filepath in old if filepath not in current and not filepath.startswith(unreadable)]
+
+        return changed, deleted
+
+    # compares only the paths watchdog said changed to the snapshot
+    def _compare_paths(self, paths):
+        changed = {}
+        deleted = []
+        for path in paths:
+            if not self._is_available(path):
+                continue
+            if os.path.isdir(path):
+                folder_changed, folder_deleted = self._compare_folder(path)
+                changed.update(folder_changed)
+                deleted += folder_deleted
+                continue
+
+            stat = _stat(path)
+            if stat is None:
+                # the folder the path was in can't be read, so it can't be told whether the path is gone
+                if not os.path.isdir(os.path.dirname(path)):
+                    continue
+                # the path was a file or a folder that's gone
+                prefix = os.path.join(path, '')
+                deleted += [filepath for filepath in self.snapshot if filepath == path or filepath.startswith(prefix)]
+            elif path in self.snapshot or os.path.splitext(path)[1][1:].lower() in folder_walker.VALID_EXTENSIONS:
+                if self.snapshot.get(path) != stat:
+                    changed[path] = stat
+
+        return changed, deleted
+
+    # finds the files that changed since the last check and updates the database with them
+    def check(self):
+        new_folders = self._update_folders()
+
+        # scan every folder if watchdog isn't being used or it's time for a full scan, otherwise only the folders that were just added
+        if self.observer is None or time.monotonic() - self.last_full_scan > RESCAN_INTERVAL:
+            self.last_full_scan = time.monotonic()
+            folders_to_scan = self.folders
+            with self.lock:
+                self.dirty.clear()
+            paths = set(self.unsettled)
+        else:
+            folders_to_scan = new_folders
+            with self.lock:
+                paths = self.dirty | set(self.unsettled)
+                self.dirty = set()
+
+        changed = {}
+        deleted = []
+        for folder_path in folders_to_scan:
+            folder_changed, folder_deleted = self._compare_folder(folder_path)
+            changed.update(folder_changed)
+            deleted += folder_deleted
+        paths_changed, paths_deleted = self._compare_paths(paths - set(changed))
+        changed.update(paths_changed)
+        deleted = list(set(deleted + paths_deleted))
+
+        # the photos whose files were deleted are removed after the files that changed with them are processed
+        for pending_deleted, _ in self.pending_deletes:
+            # a file that came back isn't deleted anymore
+            pending_deleted.difference_update(changed)
+        if deleted:
+            for filepath in deleted:
+                self.snapshot.pop(filepath, None)
+                self.unsettled.pop(filepath, None)
+            self.pending_deletes.append((set(deleted), set(changed)))
+
+        # only process files that are the same as they were at the last check
+        ready = {}
+        for filepath, stat in changed.items():
+            if self.unsettled.get(filepath) == stat:
+                ready[filepath] = stat
+                del self.unsettled[filepath]
+            else:
+                self.unsettled[filepath] = stat
+        # files that stopped existing while they were unsettled don't need to be waited for
+        for filepath in [filepath for filepath in self.unsettled if filepath not in changed and _stat(filepath) is None]:
+            del self.unsettled[filepath]
+
+        if self.stopped.is_set():
+            return
+
+        if ready:
+            print(f'Processing {len(ready)} new or changed photos')
+            # the ingest engine compares the files to their fingerprints too, so files that were only touched aren't processed
+            report = self.engine.run(list(ready))
+            if report['cancelled']:
+                # the files are checked again the next time the watcher runs
+                return
+            # files that couldn't be read aren't tried again until they change
+            self.snapshot.update(ready)
+            if report['errors']:
+                print(f'{len(report["errors"])} photos could not be processed')
+
+        self._remove_deleted()
+
+    # removes the photos of deleted files once none of the files that changed in the same check are still settling
+    # the photos of files that were moved have already been moved by the ingest engine, so only the rest are removed
+    def _remove_deleted(self):
+        remaining = []
+        deleted = set()
+        for pending_deleted, changed in self.pending_deletes:
+            if changed.isdisjoint(self.unsettled):
+                deleted |= pending_deleted
+            else:
+                remaining.append((pending_deleted, changed))
+        self.pending_deletes = remaining
+
+        if deleted:
+            removed = database_manager.delete_photos_by_filepath(deleted)
+            if removed:
+                print(f'Removed {removed} deleted photos')
+
+def main():
+    database_manager.init_database()
+    watcher = FolderWatcher(workers=ingest_engine.DEFAULT_WORKERS)
+    if Observer is None:
+        print(f'watchdog is not installed, checking for changes every {POLL_INTERVAL} seconds')
+    watcher.start()
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        watcher.stop()
+
+if __name__ == '__main__':
+    main()
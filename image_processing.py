@@ -1,103 +1,208 @@
-# YOLO is the image processing AI
-from ultralytics import YOLO
+# YOLO is the image processing AI, loaded the first time it's used by model_registry
+import model_registry
 
-from PIL import Image, ExifTags
+from PIL import Image
+
+# cv2 decodes the pixels of images into numpy arrays that both YOLO and InsightFace can read
+import cv2
+import numpy as np
 
 import re
+import io
+import calendar
+import math
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-# instantiate the YOLO model
-model = YOLO('yolo11n.pt')
+# the file extensions YOLO can read, in lowercase
+VALID_EXTENSIONS = {'webp', 'dng', 'tif', 'tiff', 'mpo', 'jpg', 'bmp', 'heic', 'png', 'jpeg', 'pfm'}
 
 # returns True if the path is compatible with YOLO, otherwise returns False
 def validate_path(filepath):
-    # valid file extensions
-    valid_extensions = {'webp', 'dng', 'tif', 'tiff', 'mpo', 'jpg', 'bmp', 'heic', 'png', 'jpeg', 'pfm'}
-
     # get the file extension of the filepath
-    file_type = re.split(r'\.', filepath)[-1]
+    # extensions are compared in lowercase so files like IMG_0001.JPG are accepted too
+    file_type = re.split(r'\.', filepath)[-1].lower()
     
     # make sure the file extension is compatible with YOLO
-    if file_type in valid_extensions:
+    if file_type in VALID_EXTENSIONS:
         return True
     
     # if the file extension is invalid, YOLO won't run
     return False
 
-# returns a set of tags detected in an image/video file
-def detect_image(filepath):
-    # YOLO11 analyzes the image
-    results = model(source=filepath, stream=True)
-
-    # create a set of tags
-    # must be a set because multiple of the same tag could be detected
-    tags = set()
+# returns the EXIF data of an opened Pillow image without decoding its pixels
+# getexif() decodes the whole image for some formats (like PNG) in case the EXIF data comes after the pixels,
+# so the EXIF data found while the header was read is used instead, and TIFF files keep theirs in the header itself
+def read_exif(image):
+    exif = Image.Exif()
+    if image.info.get('exif'):
+        exif.load(image.info['exif'])
+    elif image.format == 'TIFF':
+        exif = image.getexif()
+
+    return exif
+
+# reads and decodes an image file once so EXIF, YOLO and InsightFace can all share it
+# returns (image, metadata) where image is a BGR numpy array and metadata is (location, taken_at) from parse_exif
+def load_image(filepath):
+    with open(filepath, 'rb') as file:
+        return decode_image(file.read())
+
+# decodes the bytes of an image file
+# returns (image, metadata) where image is a BGR numpy array and metadata is (location, taken_at) from parse_exif
+def decode_image(data):
+    # Pillow only reads the header when it opens an image, so getting the EXIF data doesn't decode the pixels
+    with Image.open(io.BytesIO(data)) as image:
+        metadata = parse_exif(read_exif(image))
+
+        # cv2 decodes straight to BGR, the format YOLO and InsightFace both take, and rotates it the way the EXIF data says
+        pixels = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        # formats cv2 can't decode (like HEIC) are decoded by Pillow instead and converted from RGB to BGR
+        if pixels is None:
+            pixels = cv2.cvtColor(np.asarray(image.convert('RGB')), cv2.COLOR_RGB2BGR)
+
+    return pixels, metadata
+
+# the perceptual hash is made from a grid of HASH_SIZE x HASH_SIZE pixels, giving HASH_SIZE * HASH_SIZE bits
+HASH_SIZE = 8
+# images whose shrunken grayscale version has less difference than this between its lightest and darkest pixels
+# are treated as flat, e.g. a black frame, a blank page or a photo of the sky
+HASH_MIN_CONTRAST = 8
+
+# returns the difference hash (dHash) of a grayscale numpy array as a 64 bit integer
+# the image is shrunk to 9x8 and each bit says whether a pixel is brighter than the one to its right
+# resizing, recompressing or slightly editing an image only changes a few bits, so similar images have similar hashes
+def perceptual_hash(gray):
+    pixels = cv2.resize(gray, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    # a flat image has no edges for the bits to describe, so every flat image gets the empty hash
+    # database_manager never counts a photo with a hash like that as a near duplicate
+    if pixels.max() - pixels.min() < HASH_MIN_CONTRAST:
+        return 0
+
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+# returns the perceptual hash of a BGR numpy array from decode_image
+def get_image_hash(image):
+    return perceptual_hash(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+
+# returns the perceptual hash of a JPEG's bytes, or None if it can't be read
+# JPEGs can be decoded at an eighth of their size, which is much faster than decoding every pixel
+# other formats are decoded at full size first, so their hash should be made from the pixels they're decoded to anyway
+def read_jpeg_hash(data):
+    gray = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    return perceptual_hash(gray) if gray is not None else None
 
-    # add every detected tag to the tags list
+# returns a set of tags detected in an image/video file
+# image can be a filepath or a BGR numpy array from load_image
+def detect_image(image):
+    return detect_images([image])[0]
+
+# returns a list of tags for each image in a list of images, in the same order
+# YOLO runs on all of them in one call, which is faster than one call per image
+def detect_images(images):
+    if not images:
+        return []
+
+    # YOLO11 analyzes the images
+    model = model_registry.get_yolo()
+    results = model(source=list(images), verbose=False)
+
+    # one result per image, in the order the images were given
+    image_tags = []
     for r in results:
+        # create a set of tags
+        # must be a set because multiple of the same tag could be detected
+        tags = set()
+
+        # add every detected tag to the tags list
         for box in r.boxes:
             # cls_id is an integer that represents a tag
             cls_id = int(box.cls)
 
-            # get the name of the tag as a string
-            tag_name = model.names[cls_id]
+            # get the name of the tag as a string and add it to the set
+            tags.add(model.names[cls_id])
 
-            # add the tag to the set
-            tags.add(tag_name)
+        image_tags.append(list(tags))
 
-    return list(tags)
+    return image_tags
 
-# gets the location and timestamp from a file
-def get_image_metadata(filepath):
-    image = Image.open(filepath)
+# the number of files get_images_metadata reads at once
+# reading metadata is mostly waiting for the disk, so threads are enough and it can be more than the number of cores
+METADATA_WORKERS = 8
 
-    # get the image's EXIF data (its metadata)
-    if not hasattr(image, '_getexif'):
-        print('Image does not contain EXIF data.')
-        return (None, None)
-
-    exif_data = image._getexif()
+# the EXIF tag ids that are read, looked up directly instead of going through every tag in the image
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+DATE_TIME = 0x0132
+DATE_TIME_ORIGINAL = 0x9003
+GPS_LATITUDE_REF = 1
+GPS_LATITUDE = 2
+GPS_LONGITUDE_REF = 3
+GPS_LONGITUDE = 4
 
-    location = {}
-    timestamp = ''
+# gets the location and time an image file was taken
+# only the header of the file is read, the pixels are never decoded
+# returns (location, taken_at) like parse_exif, or (None, None) if the file can't be read
+def get_image_metadata(filepath):
+    try:
+        with Image.open(filepath) as image:
+            return parse_exif(read_exif(image))
+    except Exception as error:
+        print(f'Could not read metadata from {filepath}: {error}')
+        return (None, None)
 
-    if not exif_data:
-        print('Image does not contain EXIF data.')
+# gets the location and time of many image files, reading several at once
+# yields (filepath, location, taken_at) in the same order as filepaths
+def get_images_metadata(filepaths, workers=METADATA_WORKERS):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for filepath, (location, taken_at) in zip(filepaths, executor.map(get_image_metadata, filepaths)):
+            yield filepath, location, taken_at
+
+# turns degrees, minutes and seconds into decimal degrees, negative for south and west
+# using the formula: decimal degrees = degrees + minutes / 60 + seconds / 3600
+def _dms_to_degrees(dms, direction):
+    degrees, minutes, seconds = (float(value) for value in dms)
+    degrees = degrees + minutes / 60 + seconds / 3600
+    # Pillow reads a fraction with a denominator of 0 as NaN instead of failing
+    if not math.isfinite(degrees):
+        raise ValueError('invalid GPS coordinates')
+
+    return -degrees if direction in ('S', 'W') else degrees
+
+# turns an EXIF date like 2024:07:21 14:03:09 into seconds since 1970
+# EXIF dates don't have a time zone, so the time is stored as if it was UTC and always reads back as the same date and time
+def _exif_time_to_epoch(value):
+    if isinstance(value, bytes):
+        value = value.decode('ascii', 'ignore')
+    try:
+        taken_at = datetime.strptime(value.strip('\x00 ')[:19], '%Y:%m:%d %H:%M:%S')
+    except (AttributeError, ValueError):
+        return None
+
+    return calendar.timegm(taken_at.timetuple())
+
+# gets the location and time an image was taken from its EXIF data (a Pillow Image.Exif from read_exif)
+# returns (location, taken_at) where location is (latitude, longitude) in decimal degrees and taken_at is seconds since 1970
+# either one is None if the image doesn't have it
+def parse_exif(exif):
+    if not exif:
         return (None, None)
 
-    # get the location and timestamp from EXIF data
-    for key, value in exif_data.items():
-        if ExifTags.TAGS[key] == 'GPSInfo':
-            location = value
-        if ExifTags.TAGS[key] == 'DateTime':
-            timestamp = value
-    
-    # set location to None if EXIF data exists but GPSInfo doesn't
-    if location:
-        # parse the gps info to more useful coordinates
-        # turns DMS (Degrees, Minutes, Secons) to decimal degrees
-        # using the formula: decimal degrees = degrees + minutes / 60 + seconds / 3600
-
-        # account for different displays of location (with and without altitude)
-        if len(location.values()) == 6:
-            latitude_dir, latitude_dms, longitude_dir, longitude_dms, _, _ = (val for val in location.values())
-        elif len(location.values()) == 4:
-            latitude_dir, latitude_dms, longitude_dir, longitude_dms = (val for val in location.values())
-
-        latitude_deg = float(latitude_dms[0] + latitude_dms[1] / 60 + latitude_dms[2] / 3600)
-        if latitude_dir == 'S':
-            latitude_deg *= -1
-        longitude_deg = float(longitude_dms[0] + longitude_dms[1] / 60 + longitude_dms[2] / 3600)
-        if longitude_dir == 'W':
-            longitude_deg *= -1
-        
-        latitude_deg = round(latitude_deg, 4)
-        longitude_deg = round(longitude_deg, 4)
-        
-        location = f'{latitude_deg},{longitude_deg}'
-    else:
-        location = None
-    
-    # set timestamp to None if EXIF data exists but DateTime doesn't
-    timestamp = timestamp if timestamp else None
-            
-    return (location, timestamp)
\ No newline at end of file
+    # the location is in the GPS section of the EXIF data
+    location = None
+    gps = exif.get_ifd(GPS_IFD)
+    if GPS_LATITUDE in gps and GPS_LONGITUDE in gps:
+        try:
+            location = (_dms_to_degrees(gps[GPS_LATITUDE], gps.get(GPS_LATITUDE_REF)),
+                        _dms_to_degrees(gps[GPS_LONGITUDE], gps.get(GPS_LONGITUDE_REF)))
+        except (TypeError, ValueError, ZeroDivisionError):
+            location = None
+
+    # DateTimeOriginal is when the photo was taken, DateTime is when the file was last changed and is only used if that's missing
+    taken_at = _exif_time_to_epoch(exif.get_ifd(EXIF_IFD).get(DATE_TIME_ORIGINAL))
+    if taken_at is None:
+        taken_at = _exif_time_to_epoch(exif.get(DATE_TIME))
+
+    return (location, taken_at)
@@ -0,0 +1,540 @@
+# processes image files into the database using every core of the machine
+# a producer thread reads the files, a pool of worker processes runs EXIF, YOLO and InsightFace on them,
+# and the process that started the ingest is the only one that writes to the database
+# can be used from the UI or run on its own with: python ingest_engine.py <folder> [--workers N]
+import multiprocessing
+import threading
+import argparse
+import hashlib
+import queue
+import time
+import os
+
+import image_processing
+import face_processing
+import database_manager
+import face_clustering
+import model_registry
+import folder_walker
+
+# the number of worker processes, each one loads its own copy of YOLO and InsightFace
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 1) // 4)
+# the number of batches that can wait in each queue for every worker
+# this caps how many files are held in memory at once
+QUEUE_SIZE = 2
+
+# only one ingest runs at a time, e.g. the folder watcher waits while a folder is being processed from the settings
+# so two ingests never process the same files or cluster faces at the same time
+_ingest_lock = threading.Lock()
+
+def read_file(filepath):
+    with open(filepath, 'rb') as file:
+        return file.read()
+
+# returns the hash of a file's bytes, used to recognize a file that was edited, moved or copied
+def hash_bytes(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+# runs EXIF, YOLO and InsightFace on a batch of files
+# items is a list of (filepath, file_bytes, fingerprint) where fingerprint is (size, mtime, content_hash, perceptual_hash)
+# the perceptual hash of each file is made here from the pixels it's decoded to, so the file is only decoded once
+# if find_duplicates is True, files that look almost the same as a photo already in the database (e.g. a burst shot or a resized export)
+# aren't run through the models, they get that photo's tags and faces but keep their own location and time
+# returns (photos, copies) in the formats add_photos_to_database and copy_photos take, without the names of saved faces in tags
+def analyze_images(items, find_duplicates=False):
+    # each file is decoded once, then shared by the hash, YOLO and InsightFace, and its EXIF data is read while it's open
+    analyzed = []
+    copies = []
+    for filepath, data, fingerprint in items:
+        image, metadata = image_processing.decode_image(data)
+        fingerprint = (*fingerprint[:3], image_processing.get_image_hash(image))
+        if find_duplicates:
+            source_filepath = database_manager.find_near_duplicate(fingerprint[3], filepath)
+            if source_filepath:
+                copies.append((source_filepath, filepath, os.path.dirname(filepath), fingerprint, metadata))
+                continue
+        analyzed.append((filepath, image, metadata, fingerprint))
+
+    if not analyzed:
+        return [], copies
+
+    # YOLO tags the whole batch in one call, and InsightFace makes the embeddings of every face in it at once
+    images = [image for _, image, _, _ in analyzed]
+    batch_tags = image_processing.detect_images(images)
+    batch_faces = face_processing.detect_faces_batch(images)
+
+    photos = []
+    for (filepath, image, (location, taken_at), fingerprint), tags, faces in zip(analyzed, batch_tags, batch_faces):
+        # keep each face's bounding box, score and thumbnail with its embedding
+        # so the details window can show the faces without running InsightFace again
+        faces = face_processing.get_face_records(image, faces)
+        photos.append((filepath, os.path.dirname(filepath), location, taken_at, tags, faces, fingerprint))
+
+    return photos, copies
+
+# adds the names of the saved faces found in each photo to its tags
+# done by the writer, since it's the only process that keeps the saved faces up to date
+def label_photos(photos):
+    for photo in photos:
+        face_tags = set(face_processing.label_faces([face[0] for face in photo[5]]))
+        photo[4].extend(name for name in face_tags if name and name not in photo[4])
+
+    return photos
+
+# analyzes a batch, and if that fails, each file on its own so one bad file doesn't lose the whole batch
+# returns (photos, copies, errors) where errors is a list of (filepath, message)
+def _analyze_safely(items, find_duplicates):
+    try:
+        return (*analyze_images(items, find_duplicates), [])
+    except Exception:
+        photos = []
+        copies = []
+        errors = []
+        for item in items:
+            try:
+                item_photos, item_copies = analyze_images([item], find_duplicates)
+                photos += item_photos
+                copies += item_copies
+            except Exception as error:
+                errors.append((item[0], str(error)))
+
+        return photos, copies, errors
+
+# the loop each worker process runs
+# the models are loaded once when the worker starts, then it analyzes batches until it's given None
+# every batch gets exactly one result, so the writer knows it's done once it has a result for every batch it was sent
+def _worker_main(task_queue, result_queue, model_config, find_duplicates):
+    model_registry.configure(**model_config)
+    try:
+        model_registry.warm_up()
+    except Exception as error:
+        result_queue.put(('failed', [], [(None, f'Could not load the models: {error}')]))
+        return
+
+    while True:
+        items = task_queue.get()
+        if items is None:
+            break
+        photos, copies, errors = _analyze_safely(items, find_duplicates)
+        # the copies are sent first, so they're written before the writer sees that the batch is finished
+        if copies:
+            result_queue.put(('copies', copies, []))
+        result_queue.put(('photos', photos, errors))
+
+# processes a list of image files into the database
+# use as engine = IngestEngine(...) then engine.run(filepaths), cancel() can be called from another thread
+# with keep_workers, the worker processes and their models are kept between runs until close() is called
+# so an engine that's run often on a few files (like the folder watcher's) doesn't load the models every time
+# if events is a queue.Queue, progress is reported on it as dictionaries while run is working:
+#   {'type': 'progress', 'file': str, 'done': int, 'total': int, 'images_per_second': float, 'eta': float, 'errors': int}
+#   (total and eta are None if the files are given as a generator, since the number of files isn't known)
+#   {'type': 'finished', 'report': dict} once, after everything has been written
+#   {'type': 'failed', 'message': str} instead of finished if start was used and the ingest stopped with an error
+# done counts the files that were processed, copied, skipped or failed, and eta is in seconds (None until it can be estimated)
+class IngestEngine:
+    def __init__(self, workers=DEFAULT_WORKERS, batch_size=None, queue_size=QUEUE_SIZE, reprocess=False, events=None,
+                 keep_workers=False):
+        self.workers = max(1, workers)
+        # the number of files given to a worker at once, which is also the number given to the models at once
+        self.batch_size = batch_size or model_registry.config['batch_size']
+        self.queue_size = max(1, queue_size)
+        # process files that are already in the database again, even if they haven't changed
+        self.reprocess = reprocess
+        self.cancelled = threading.Event()
+        # where progress is reported, a queue so it can be read safely from another thread (e.g. the UI)
+        self.events = events
+        self.keep_workers = keep_workers
+
+        # the worker processes and the queues to and from them, the workers are started when the first batch is sent
+        self.processes = []
+        self.task_queue = None
+        self.result_queue = None
+
+        self._reset_counts()
+
+    # the counts for the report returned by run, reset at the start of every run
+    def _reset_counts(self):
+        self.processed = 0
+        # files that are copies or near duplicates of photos already in the database, which get the tags and faces of that photo
+        self.copied = 0
+        # unchanged files, counted by the producer
+        self.skipped = 0
+        # files that were only touched or never had their fingerprint stored, counted by the writer
+        self.refreshed = 0
+        self.errors = []
+        # the number of batches the producer gave to the workers
+        self.batches_sent = 0
+
+    # stops the ingest straight away, the workers are stopped in the middle of what they're doing
+    # the photos that were already processed are still written to the database
+    def cancel(self):
+        self.cancelled.set()
+
+    # makes the queues to and from the workers, unless the ones kept from the last run are still open
+    def _open_queues(self):
+        if self.task_queue is not None:
+            return
+
+        # spawn starts each worker from a fresh interpreter on every platform
+        # so workers never inherit the database connection or half-loaded models of this process
+        context = multiprocessing.get_context('spawn')
+        self.task_queue = context.Queue(maxsize=self.workers * self.queue_size)
+        self.result_queue = context.Queue(maxsize=self.workers * self.queue_size)
+        # batches left in the queues when the app closes aren't needed
+        # without this, the threads that feed the queues would stop the process from exiting until the batches were read
+        for ipc_queue in (self.task_queue, self.result_queue):
+            ipc_queue.cancel_join_thread()
+
+    # starts the worker processes, unless they're already running
+    # called by the producer just before it sends the first batch, so a run with nothing to process never loads the models
+    def _start_workers(self):
+        if self.processes:
+            return
+
+        # split the CPU between the workers so their models don't fight over the same cores
+        model_config = dict(model_registry.config)
+        if not model_config['num_threads']:
+            model_config['num_threads'] = max(1, (os.cpu_count() or 1) // self.workers)
+
+        # near duplicates are only looked for when files aren't being processed again on purpose
+        context = multiprocessing.get_context('spawn')
+        args = (self.task_queue, self.result_queue, model_config, not self.reprocess)
+        processes = [context.Process(target=_worker_main, args=args, daemon=True) for _ in range(self.workers)]
+        for process in processes:
+            process.start()
+        # only set once they've all started, since the writer checks them from its own thread
+        self.processes = processes
+
+    # stops the worker processes
+    # if wait is True, idle workers are asked to exit, otherwise they're stopped in the middle of what they're doing
+    def _stop_workers(self, wait=False):
+        if wait:
+            for _ in self.processes:
+                try:
+                    self.task_queue.put_nowait(None)
+                except queue.Full:
+                    break
+            for process in self.processes:
+                process.join(timeout=5)
+
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        self.processes = []
+
+        if self.task_queue is not None:
+            self.task_queue.close()
+            self.result_queue.close()
+            self.task_queue = None
+            self.result_queue = None
+
+    # stops the workers kept by keep_workers, waiting for a run that's still going to finish first
+    def close(self):
+        with _ingest_lock:
+            self._stop_workers(wait=True)
+
+    def _send_event(self, event):
+        if self.events is not None:
+            self.events.put(event)
+
+    # reports how far the ingest has got
+    def _send_progress(self, current_file, total, start_time):
+        done = self.processed + self.copied + self.skipped + self.refreshed + len(self.errors)
+        elapsed = max(time.perf_counter() - start_time, 1e-6)
+        # estimate the time left from how long the files done so far took
+        eta = (total - done) * elapsed / done if done and total is not None else None
+
+        self._send_event({
+            'type': 'progress',
+            'file': current_file,
+            'done': done,
+            'total': total,
+            'images_per_second': self.processed / elapsed,
+            'eta': eta,
+            'errors': len(self.errors),
+        })
+
+    # puts an item on a queue, waiting while it's full unless the ingest is cancelled
+    # returns False if it was cancelled before the item could be added
+    def _put(self, task_queue, item):
+        while not self.cancelled.is_set():
+            try:
+                task_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    # decides what to do with a file by comparing it to the fingerprint stored when it was last processed
+    # returns one of:
+    #   ('skip', None) if the file hasn't changed
+    #   ('fingerprint', (filepath, size, mtime, content_hash, perceptual_hash)) if only its fingerprint needs to be recorded
+    #   ('copy', (source_filepath, filepath, folder_path, fingerprint, None)) if it's a copy of a photo already in the database
+    #   ('process', (filepath, file_bytes, fingerprint)) if it has to be given to a worker
+    # the perceptual hash of a file that's given to a worker is None until the worker decodes it
+    def _check_file(self, filepath):
+        stat = os.stat(filepath)
+        stored = database_manager.get_fingerprint(filepath)
+        # only the hash of a JPEG is quick enough to make here, any other format would be decoded at full size by this one thread
+        is_jpeg = os.path.splitext(filepath)[1].lower() in ('.jpg', '.jpeg')
+
+        # the size and time the file was modified are the same, so it doesn't even need to be read
+        # unless it's a JPEG that was processed before perceptual hashes were stored
+        if (stored is not None and not self.reprocess and stored[:2] == (stat.st_size, stat.st_mtime_ns)
+                and (stored[3] is not None or not is_jpeg)):
+            return 'skip', None
+
+        data = read_file(filepath)
+        fingerprint = (stat.st_size, stat.st_mtime_ns, hash_bytes(data), None)
+        if not self.reprocess:
+            # the file was touched without changing it, or it was processed before fingerprints were stored
+            # either way the photo in the database is still right
+            if stored is not None and stored[2] in (None, fingerprint[2]):
+                perceptual_hash = stored[3]
+                if perceptual_hash is None and is_jpeg:
+                    perceptual_hash = image_processing.read_jpeg_hash(data)
+                return 'fingerprint', (filepath, *fingerprint[:3], perceptual_hash)
+
+            # the file was moved, renamed or copied from a photo that's already in the database
+            # near duplicates are found by the workers, once they've decoded the file
+            source_filepath = database_manager.find_photo_by_hash(fingerprint[2], filepath)
+            if source_filepath:
+                return 'copy', (source_filepath, filepath, os.path.dirname(filepath), fingerprint, None)
+
+        return 'process', (filepath, data, fingerprint)
+
+    # gives a batch to the workers, starting them first if it's the first batch of the run
+    # returns False if the ingest was cancelled before the batch could be sent
+    def _send_batch(self, task_queue, batch):
+        self._start_workers()
+        if not self._put(task_queue, batch):
+            return False
+        self.batches_sent += 1
+
+        return True
+
+    # the producer, reads the files that need processing and gives them to the workers in batches
+    # fingerprints and copies don't need the models, so they go straight to the writer
+    def _produce(self, filepaths, task_queue, result_queue):
+        batch = []
+        fingerprints = []
+        copies = []
+        for filepath in filepaths:
+            if self.cancelled.is_set():
+                return
+
+            if not image_processing.validate_path(filepath):
+                self.skipped += 1
+                continue
+
+            try:
+                action, item = self._check_file(filepath)
+            except OSError as error:
+                self.errors.append((filepath, str(error)))
+                continue
+
+            if action == 'process':
+                batch.append(item)
+            elif action == 'fingerprint':
+                fingerprints.append(item)
+            elif action == 'copy':
+                copies.append(item)
+            else:
+                self.skipped += 1
+
+            if len(batch) >= self.batch_size:
+                if not self._send_batch(task_queue, batch):
+                    return
+                batch = []
+            if len(fingerprints) >= database_manager.INGEST_BATCH_SIZE:
+                if not self._put(result_queue, ('fingerprints', fingerprints, [])):
+                    return
+                fingerprints = []
+            if len(copies) >= database_manager.INGEST_BATCH_SIZE:
+                if not self._put(result_queue, ('copies', copies, [])):
+                    return
+                copies = []
+
+        if batch and not self._send_batch(task_queue, batch):
+            return
+        if fingerprints and not self._put(result_queue, ('fingerprints', fingerprints, [])):
+            return
+        if copies and not self._put(result_queue, ('copies', copies, [])):
+            return
+
+        # tell the writer that every batch has been sent
+        self._put(result_queue, ('done', [], []))
+
+    # processes the files and writes them to the database, returning once they're all done or the ingest is cancelled
+    # filepaths can be any iterable, like a generator from folder_walker, and is only read as fast as the files are processed
+    # returns a report dictionary of the number of photos processed, copied and skipped, the errors, and how fast it went
+    def run(self, filepaths):
+        start_time = time.perf_counter()
+        self.cancelled.clear()
+        self._reset_counts()
+
+        # wait for any other ingest to finish, unless this one is cancelled while it's waiting
+        while not _ingest_lock.acquire(timeout=0.5):
+            if self.cancelled.is_set():
+                return self._finish(start_time, True)
+
+        try:
+            was_cancelled = self._run(filepaths, start_time)
+            # group the new faces with the faces of people that were already found
+            face_clustering.cluster_new_faces()
+        finally:
+            _ingest_lock.release()
+
+        return self._finish(start_time, was_cancelled)
+
+    # does the work of run while it holds the ingest lock, returns True if the ingest was cancelled
+    def _run(self, filepaths, start_time):
+        # the number of files isn't known ahead of time if filepaths is a generator
+        total = len(filepaths) if hasattr(filepaths, '__len__') else None
+
+        # the workers kept from the last run are only used again if they're all still running
+        if not all(process.is_alive() for process in self.processes):
+            self._stop_workers()
+        self._open_queues()
+        result_queue = self.result_queue
+
+        producer = threading.Thread(target=self._produce, args=(filepaths, self.task_queue, result_queue), daemon=True)
+        producer.start()
+
+        # this is the only place that writes to the database
+        pending_photos = []
+        producer_done = False
+        batches_done = 0
+        current_file = None
+        worker_exited = False
+        try:
+            # the producer says when it's done, then the workers have to finish every batch it sent
+            while not (producer_done and batches_done >= self.batches_sent) and not self.cancelled.is_set():
+                try:
+                    # a short timeout so cancelling is noticed straight away
+                    kind, photos, errors = result_queue.get(timeout=0.1)
+                except queue.Empty:
+                    # workers are only asked to exit between runs, so one that exits now crashed or couldn't load the models
+                    # the batch it had will never come back, so the ingest stops instead of waiting for it forever
+                    # the queue is read once more first, for anything the worker sent just before it exited
+                    if worker_exited:
+                        break
+                    worker_exited = any(process.exitcode is not None for process in self.processes)
+                    continue
+
+                if kind == 'fingerprints':
+                    database_manager.set_fingerprints(photos)
+                    self.refreshed += len(photos)
+                    self._send_progress(photos[-1][0], total, start_time)
+                    continue
+                if kind == 'copies':
+                    missing = database_manager.copy_photos(photos)
+                    self.copied += len(photos) - len(missing)
+                    self.errors += [(filepath, 'The photo it was copied from was removed, it will be processed on the next scan')
+                                    for filepath in missing]
+                    self._send_progress(photos[-1][1], total, start_time)
+                    continue
+                if kind == 'done':
+                    producer_done = True
+                    continue
+                if kind == 'failed':
+                    self.errors += errors
+                    continue
+
+                batches_done += 1
+                pending_photos += label_photos(photos)
+                self.processed += len(photos)
+                self.errors += errors
+                if photos or errors:
+                    current_file = (photos[-1][0] if photos else errors[-1][0]) or current_file
+                    self._send_progress(current_file, total, start_time)
+
+                # write the processed photos to the database once a full batch is ready
+                if len(pending_photos) >= database_manager.INGEST_BATCH_SIZE:
+                    database_manager.add_photos_to_database(pending_photos)
+                    pending_photos = []
+        finally:
+            was_cancelled = self.cancelled.is_set()
+            finished = producer_done and batches_done >= self.batches_sent
+
+            # stop the producer
+            self.cancelled.set()
+            producer.join()
+            # the files in the batches that didn't come back are processed on the next run, since they weren't saved
+            if worker_exited and not finished:
+                self.errors.append((None, f'A worker stopped unexpectedly, {self.batches_sent - batches_done} batches of files were not processed'))
+            # the workers are kept for the next run if they finished everything they were given
+            # otherwise batches could still be waiting for them, so they're stopped
+            if not finished:
+                self._stop_workers()
+            elif not self.keep_workers:
+                self._stop_workers(wait=True)
+
+            # write the photos from the last batch, including when the ingest was cancelled
+            database_manager.add_photos_to_database(pending_photos)
+
+        return was_cancelled
+
+    # makes the report returned by run and reports that the ingest finished
+    def _finish(self, start_time, was_cancelled):
+        elapsed = time.perf_counter() - start_time
+        report = {
+            'processed': self.processed,
+            'copied': self.copied,
+            'skipped': self.skipped + self.refreshed,
+            'errors': self.errors,
+            'cancelled': was_cancelled,
+            'elapsed': elapsed,
+            'images_per_second': self.processed / max(elapsed, 1e-6),
+        }
+        self._send_event({'type': 'finished', 'report': report})
+
+        return report
+
+    # runs the ingest on a background thread and returns the thread
+    # progress has to be read from events, since nothing is returned
+    def start(self, filepaths):
+        thread = threading.Thread(target=self._run_in_background, args=(filepaths,), daemon=True)
+        thread.start()
+
+        return thread
+
+    # there's no caller to raise an error to on a background thread, so it's reported on events instead
+    def _run_in_background(self, filepaths):
+        try:
+            self.run(filepaths)
+        except Exception as error:
+            self._send_event({'type': 'failed', 'message': str(error)})
+
+def main():
+    parser = argparse.ArgumentParser(description='Process the images in folders into the database.')
+    parser.add_argument('folders', nargs='+', help='the folders to process')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='the number of worker processes')
+    parser.add_argument('--batch-size', type=int, default=None, help='the number of images given to the models at once')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE, help='the number of batches that can wait for each worker')
+    parser.add_argument('--reprocess', action='store_true', help='process images that are already in the database again')
+    parser.add_argument('--include', action='append', default=[], help='only process files matching this pattern (can be repeated)')
+    parser.add_argument('--exclude', action='append', default=[], help='skip files and folders matching this pattern (can be repeated)')
+    args = parser.parse_args()
+
+    database_manager.init_database()
+    folder_paths = [os.path.abspath(folder_path) for folder_path in args.folders]
+    for folder_path in folder_paths:
+        database_manager.add_folder(folder_path)
+
+    # the files are found while they're being processed instead of all at once beforehand
+    filepaths = (filepath for folder_path in folder_paths
+                 for filepath in folder_walker.walk_folder(folder_path, args.include, args.exclude))
+
+    engine = IngestEngine(args.workers, args.batch_size, args.queue_size, args.reprocess)
+    report = engine.run(filepaths)
+
+    for filepath, message in report['errors']:
+        print(f'Error processing {filepath}: {message}' if filepath else message)
+    print(f'Processed {report["processed"]} images, copied {report["copied"]} and skipped {report["skipped"]} in {report["elapsed"]:.1f}s '
+          f'({report["images_per_second"]:.1f} images/sec)')
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ import text_processing
 import database_manager
 import settings_ui
 import details_ui
+import folder_watcher
 
 # Pillow allows TKinter to display a wider variety of file types
 from PIL import Image, ImageTk
@@ -21,6 +22,10 @@ class MainUI:
         # initialize the database
         database_manager.init_database()
 
+        # keep the added folders indexed in the background, so new photos can be searched without processing the folder
+        self.folder_watcher = folder_watcher.FolderWatcher()
+        self.folder_watcher.start()
+
         # initialize the window's dimensions and title
         self.window = tk.Tk()
         self.window.geometry('1920x1080')
@@ -65,6 +70,9 @@ class MainUI:
         # displays the window
         self.window.mainloop()
 
+        # stop any ingest the watcher is running once the window is closed
+        self.folder_watcher.stop()
+
     # updates the scrollbar to fit the canvas, required for applications which use canvas and scrollbar
     def update_scroll_region(self, _):
         self.canvas.config(scrollregion=self.canvas.bbox('all'))
@@ -77,14 +85,21 @@ class MainUI:
         # clear the text area
         self.input_text.delete('1.0', tk.END)
 
-        # get the tags used by YOLO11 
-        valid_tags = database_manager.get_found_tags()
-        # sends it to the LLM
-        request_output = text_processing.process_input(input, valid_tags, database_manager.get_use_metadata())
-
-        # run the algorithm which finds the images with the most similar tags to the ones given by LLaMa
-        photos = database_manager.get_all_photos()
-        photo_paths = text_processing.search(photos, request_output, database_manager.get_max_photos())
+        # first look for photos whose tags, face names, folder or file name match every word of the request
+        # this is answered straight from the database so it's much faster than asking the LLM
+        photo_paths = database_manager.full_text_search(input, database_manager.get_max_photos())
+
+        # fall back to the LLM if nothing matched
+        if not photo_paths:
+            # get the tags used by YOLO11 
+            valid_tags = database_manager.get_found_tags()
+            # sends it to the LLM
+            request_output = text_processing.process_input(input, valid_tags, database_manager.get_use_metadata())
+
+            # get the photos that share at least one tag with the ones given by LLaMa
+            photos = database_manager.search_photos_by_tags(request_output[0])
+            # run the algorithm which finds the images with the most similar tags to the ones given by LLaMa
+            photo_paths = text_processing.search(photos, request_output, database_manager.get_max_photos())
 
         # display the images to the canvas
         self.display_photos(photo_paths)
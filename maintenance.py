@@ -0,0 +1,81 @@
+# cleans up the library and shrinks the database
+# can be run from the settings window or on its own with: python maintenance.py
+import database_manager
+import image_processing
+
+import os
+import argparse
+
+# finds photos in the database whose files have been deleted or moved and removes them
+# photos in folders that aren't available, like on a drive that's unplugged, are kept
+# returns the number of photos removed
+def remove_missing_files():
+    folders = database_manager.get_folders()
+    missing_photo_ids = [photo_id for photo_id, filepath in database_manager.iter_photo_filepaths() if not os.path.exists(filepath) and database_manager.is_available(filepath, folders)]
+    database_manager.delete_photos(missing_photo_ids)
+
+    return len(missing_photo_ids)
+
+# the number of photos whose metadata is saved in each transaction by refresh_metadata
+METADATA_BATCH_SIZE = 500
+
+# reads the location and time of every photo from its file again, without running the models
+# fixes photos added by older versions, which used the time the file was last changed instead of when the photo was taken
+# returns the number of photos updated
+def refresh_metadata():
+    filepaths = [filepath for _, filepath in database_manager.iter_photo_filepaths() if os.path.exists(filepath)]
+
+    batch = []
+    for photo in image_processing.get_images_metadata(filepaths):
+        batch.append(photo)
+        if len(batch) >= METADATA_BATCH_SIZE:
+            database_manager.set_photo_metadata(batch)
+            batch = []
+    if batch:
+        database_manager.set_photo_metadata(batch)
+
+    return len(filepaths)
+
+# runs every maintenance step and returns a report of what it did
+# the report is a dictionary with the number of missing photos and orphaned rows removed and the bytes reclaimed
+def run_maintenance(check_files=True):
+    size_before = database_manager.get_database_size()
+
+    # removing missing photos first means their tags and faces are deleted with them
+    missing_photos = remove_missing_files() if check_files else 0
+    orphans = database_manager.remove_orphans()
+    # the embeddings of deleted faces stay in the embedding file until it's compacted
+    orphans['embeddings'] = database_manager.compact_embeddings()
+    database_manager.compact_database()
+
+    size_after = database_manager.get_database_size()
+
+    return {
+        'missing_photos': missing_photos,
+        'orphans': orphans,
+        'size_before': size_before,
+        'size_after': size_after,
+        'bytes_reclaimed': max(size_before - size_after, 0),
+    }
+
+# turns a report from run_maintenance into text that can be shown to the user
+def report_to_readable(report):
+    orphans = ', '.join(f'{count} from {table}' for table, count in report['orphans'].items())
+    return (f'Removed {report["missing_photos"]} photos whose files no longer exist.\n'
+            f'Removed orphaned rows: {orphans}.\n'
+            f'Database size: {report["size_before"] / 1e6:.2f} MB -> {report["size_after"] / 1e6:.2f} MB '
+            f'({report["bytes_reclaimed"] / 1e6:.2f} MB reclaimed).')
+
+def main():
+    parser = argparse.ArgumentParser(description='Clean up the image library and compact the database.')
+    parser.add_argument('--keep-missing', action='store_true', help='don\'t remove photos whose files no longer exist')
+    parser.add_argument('--refresh-metadata', action='store_true', help='read the location and time of every photo from its file again')
+    args = parser.parse_args()
+
+    database_manager.init_database()
+    if args.refresh_metadata:
+        print(f'Read the metadata of {refresh_metadata()} photos')
+    print(report_to_readable(run_maintenance(check_files=not args.keep_missing)))
+
+if __name__ == '__main__':
+    main()
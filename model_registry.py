@@ -0,0 +1,127 @@
+# loads the YOLO and InsightFace models the first time they're used instead of when the app starts
+# importing ultralytics and insightface and loading their weights takes several seconds,
+# so the window opens straight away and only the parts of the app that need a model wait for it
+import threading
+
+import numpy as np
+
+# the weights YOLO is loaded from
+YOLO_WEIGHTS = 'yolo11n.pt'
+# the InsightFace model pack
+FACE_MODEL = 'buffalo_l'
+
+# how the models are run, change with configure() before the models are loaded
+# det_size is the size InsightFace scales images to before looking for faces, smaller is faster but misses small faces
+# providers are the ONNX Runtime execution providers InsightFace can use, in order of preference (None uses its default)
+# num_threads is the number of CPU threads each model can use (None lets the libraries decide)
+# batch_size is the number of images given to the models at once when a folder is processed
+config = {
+    'det_size': (640, 640),
+    'providers': None,
+    'num_threads': None,
+    'batch_size': 8,
+}
+
+# the models that have been loaded, by name
+_models = {}
+# stops two threads from loading the same model at once
+_lock = threading.Lock()
+
+# changes how the models are run
+# models that have already been loaded keep their old settings until unload() is called
+def configure(det_size=None, providers=None, num_threads=None, batch_size=None):
+    if det_size is not None:
+        config['det_size'] = tuple(det_size)
+    if providers is not None:
+        config['providers'] = list(providers)
+    if num_threads is not None:
+        config['num_threads'] = num_threads
+    if batch_size is not None:
+        config['batch_size'] = max(1, batch_size)
+
+# a small black image that the models are run on once after they're loaded
+def _blank_image():
+    return np.zeros((64, 64, 3), dtype=np.uint8)
+
+def _load_yolo():
+    # imported here because importing ultralytics also imports torch, which is slow
+    import torch
+    from ultralytics import YOLO
+
+    if config['num_threads']:
+        torch.set_num_threads(config['num_threads'])
+
+    model = YOLO(YOLO_WEIGHTS)
+    # the first run of a model is slower than the rest, so get it out of the way before real images are processed
+    model(source=_blank_image(), verbose=False)
+
+    return model
+
+def _load_face_app():
+    # imported here because importing insightface also imports onnxruntime, which is slow
+    import onnxruntime
+    from insightface.app import FaceAnalysis
+
+    # these are passed through FaceAnalysis to the ONNX Runtime session of each of its models
+    options = {}
+    if config['num_threads']:
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = config['num_threads']
+        options['sess_options'] = session_options
+    if config['providers']:
+        options['providers'] = config['providers']
+
+    app = FaceAnalysis(name=FACE_MODEL, **options)
+    app.prepare(ctx_id=0, det_size=config['det_size'])
+    app.get(_blank_image())
+
+    return app
+
+# the function that loads each model
+_LOADERS = {
+    'yolo': _load_yolo,
+    'face': _load_face_app,
+}
+
+# returns a model, loading it if this is the first time it's been asked for
+def get_model(name):
+    model = _models.get(name)
+    if model is None:
+        with _lock:
+            # another thread may have loaded it while this one was waiting
+            model = _models.get(name)
+            if model is None:
+                model = _LOADERS[name]()
+                _models[name] = model
+
+    return model
+
+# returns the YOLO model used to tag images
+def get_yolo():
+    return get_model('yolo')
+
+# returns the InsightFace app used to find faces
+def get_face_app():
+    return get_model('face')
+
+# returns True if the model has already been loaded
+def is_loaded(name):
+    return name in _models
+
+# forgets the loaded models so the next use loads them again with the current config
+def unload():
+    with _lock:
+        _models.clear()
+
+# loads the models that haven't been loaded yet
+def warm_up(names=('yolo', 'face')):
+    for name in names:
+        get_model(name)
+
+# warms the models up in a background thread so they're ready by the time they're needed
+# the thread is a daemon so it never keeps the app open
+def warm_up_in_background(names=('yolo', 'face')):
+    thread = threading.Thread(target=warm_up, args=(names,), daemon=True)
+    thread.start()
+
+    return thread
@@ -1,7 +1,8 @@
 import text_processing
-import image_processing
-import face_processing
 import database_manager
+import maintenance
+import ingest_engine
+import folder_walker
 
 import tkinter as tk
 from tkinter import ttk
@@ -9,6 +10,8 @@ from tkinter import messagebox
 from tkinter import filedialog
 
 import os
+import queue
+import threading
 
 # this is the UI that is created when the user opens the settings
 class SettingsUI:
@@ -71,11 +74,16 @@ class SettingsUI:
         self.process_folder_button.config(state=tk.DISABLED)
 
         # button that cancels the processing of a folder
-        self.processing_disabled = True
+        # ingest is the ingest engine processing a folder in the background, None when nothing is being processed
+        self.ingest = None
         self.cancel_processing_button = tk.Button(self.buttons_frame, text='Cancel Processing', command=lambda: self.cancel_processing())
         self.cancel_processing_button.pack(padx=10, pady=10, side=tk.LEFT)
         self.cancel_processing_button.config(state=tk.DISABLED)
 
+        # button that removes leftover data and shrinks the database
+        self.clean_up_button = tk.Button(self.buttons_frame, text='Clean Up Library', command=lambda: self.clean_up_library())
+        self.clean_up_button.pack(padx=10, pady=10, side=tk.LEFT)
+
         # checkbox for reprocessing already seen imags
         self.reprocess_images = tk.BooleanVar(value=database_manager.get_reprocess_images())
         self.reprocessing_checkbox = tk.Checkbutton(self.settings_window, text='Reprocess duplicate photos', variable=self.reprocess_images, command=lambda: database_manager.set_reprocess_images(self.reprocess_images.get()))
@@ -124,64 +132,124 @@ class SettingsUI:
             self.deselect_folder()
 
     # process every image in the selected folder
+    # the images are processed in the background by the ingest engine so the app stays responsive
     def process_selected_folder(self):
         selected_index = self.folders_listbox.curselection()
-        if selected_index:
+        # only one folder is processed at a time
+        if selected_index and self.ingest is None:
             # make the user confirm that they want to process the folder
             if messagebox.askokcancel('Confirm', 'Are you sure you want to process this folder? This may take a while depending on the size of the folder.', parent=self.settings_window):
                 # enable the cancel processing button
-                self.processing_disabled = False
+                self.process_folder_button.config(state=tk.DISABLED)
                 self.cancel_processing_button.config(state=tk.ACTIVE)
 
                 folder_path = self.folders_listbox.get(selected_index)
-                file_list = os.listdir(folder_path)
-                self.process_folder(folder_path, file_list, 0)
-
-    # process the selected folder
-    def process_folder(self, folder_path, file_list, index):
-        if index < len(file_list) and not self.processing_disabled:
-            file_name = file_list[index]
-            filepath = os.path.join(folder_path, file_name)
-            self.process_image(filepath)
-
-            # update the label to show what is processing
-            # it actually shows the next file since it doesn't update until processing the current file finishes
-            # which lets it remain accurate
-            if index < len(file_list) - 1:
-                self.folders_label.config(text=f'Processing {file_list[index + 1]} ({index + 2}/{len(file_list)})')
-            
-            # process the next file in the folder
-            self.parent.after(25, self.process_folder, folder_path, file_list, index + 1)
-        else:
-            # alert the user that processing has completed
-            messagebox.showinfo('Alert', 'Processing has finished.', parent=self.settings_window)
-            self.folders_label.config(text='List of inputted folders:')
-            self.deselect_folder()
-
-    # process a single image in a folder
-    def process_image(self, filepath):
-        # validate the filepath
-        if image_processing.validate_path(filepath):
-            # don't process if it has already been processed
-            if database_manager.is_photo_in_database(filepath) and not self.reprocess_images.get():
-                print('Photo already exists in database')
+                # the folder and the folders inside it are searched while the files are processed
+                # so processing starts straight away, even in very large folders
+                file_list = folder_walker.walk_folder(folder_path)
+                self.folders_label.config(text=f'Starting to process {folder_path}...')
+
+                # progress comes back from the engine's thread on this queue, and is read by poll_processing
+                self.processing_events = queue.Queue()
+                self.ingest = ingest_engine.IngestEngine(reprocess=self.reprocess_images.get(), events=self.processing_events)
+                self.ingest.start(file_list)
+                self.parent.after(100, self.poll_processing)
+
+    # shows the progress of the folder being processed
+    # runs on the Tk thread every 100ms until the ingest has finished
+    def poll_processing(self):
+        finished_event = None
+        progress = None
+        # only the latest progress needs to be shown
+        while True:
+            try:
+                event = self.processing_events.get_nowait()
+            except queue.Empty:
+                break
+            if event['type'] == 'progress':
+                progress = event
             else:
-                print(f'Processing: {filepath}')
-                # get all the image data (tags and faces)
-                folder_path = os.path.dirname(filepath)
-                location, timestamp = image_processing.get_image_metadata(filepath)
-                tags = image_processing.detect_image(filepath)
-                faces = face_processing.detect_image(filepath)[1]
-                face_embeddings = [face.normed_embedding for face in faces]
-                face_tags = list(set(face_processing.label_faces(face_embeddings)))
-                face_tags = [name for name in face_tags if name]
-                tags += face_tags
-                # add it to the database
-                database_manager.add_photo_to_database(filepath, folder_path, location, timestamp, tags, face_embeddings)
+                finished_event = event
+
+        # the settings window could have been closed while processing, but processing carries on without it
+        window_open = self.settings_window.winfo_exists()
+
+        if finished_event is None:
+            if progress and window_open:
+                self.folders_label.config(text=self.progress_to_readable(progress))
+            self.parent.after(100, self.poll_processing)
+            return
+
+        self.ingest = None
+        if not window_open:
+            return
+
+        # alert the user that processing has completed
+        if finished_event['type'] == 'failed':
+            messagebox.showerror('Error', f'Processing stopped because of an error: {finished_event["message"]}', parent=self.settings_window)
         else:
-            print('This file is not supported by YOLO')
-        
+            report = finished_event['report']
+            print(f'Processed {report["processed"]} images in {report["elapsed"]:.1f}s ({report["images_per_second"]:.1f} images/sec)')
+            for filepath, message in report['errors']:
+                print(f'Error processing {filepath}: {message}' if filepath else message)
+            status = 'cancelled' if report['cancelled'] else 'finished'
+            messagebox.showinfo('Alert', f'Processing has {status}. {report["processed"]} images were processed, {report["copied"]} were copies or near duplicates of images that were already processed, and {len(report["errors"])} could not be read.', parent=self.settings_window)
+        self.folders_label.config(text='List of inputted folders:')
+        self.deselect_folder()
+
+    # turns a progress event from the ingest engine into text for the label
+    def progress_to_readable(self, progress):
+        # the total isn't known while the folder is still being searched
+        done = progress['done'] if progress['total'] is None else f'{progress["done"]}/{progress["total"]}'
+        text = f'Processing {os.path.basename(progress["file"] or "")} ({done}, {progress["images_per_second"]:.1f} images/sec'
+        if progress['eta'] is not None:
+            minutes, seconds = divmod(int(progress['eta']), 60)
+            text += f', {minutes}m {seconds}s left'
+        if progress['errors']:
+            text += f', {progress["errors"]} errors'
+
+        return text + ')'
+
     # cancel the processing of a folder
+    # the workers are stopped straight away, and the images they already finished are still saved
     def cancel_processing(self):
-        self.processing_disabled = True
-        
\ No newline at end of file
+        if self.ingest is not None:
+            self.ingest.cancel()
+            self.cancel_processing_button.config(state=tk.DISABLED)
+
+    # removes photos whose files are gone and leftover rows, then compacts the database
+    # this can take a while on a big library, so it runs on a background thread like the ingest
+    def clean_up_library(self):
+        if messagebox.askokcancel('Confirm', 'Remove photos whose files no longer exist and compact the database?', parent=self.settings_window):
+            self.clean_up_button.config(state=tk.DISABLED)
+
+            # the result comes back from the thread on this queue, and is read by poll_clean_up
+            self.clean_up_events = queue.Queue()
+            threading.Thread(target=self._run_clean_up, args=(self.clean_up_events,), daemon=True).start()
+            self.parent.after(100, self.poll_clean_up)
+
+    # runs on the background thread, errors are put on the queue because there's nothing else to raise them to
+    def _run_clean_up(self, events):
+        try:
+            events.put({'type': 'finished', 'report': maintenance.run_maintenance()})
+        except Exception as error:
+            events.put({'type': 'failed', 'message': str(error)})
+
+    # shows the result of the clean up once it has finished
+    # runs on the Tk thread every 100ms until then
+    def poll_clean_up(self):
+        try:
+            event = self.clean_up_events.get_nowait()
+        except queue.Empty:
+            self.parent.after(100, self.poll_clean_up)
+            return
+
+        # the settings window could have been closed while cleaning up
+        if not self.settings_window.winfo_exists():
+            return
+
+        self.clean_up_button.config(state=tk.NORMAL)
+        if event['type'] == 'failed':
+            messagebox.showerror('Error', f'Cleaning up stopped because of an error: {event["message"]}', parent=self.settings_window)
+        else:
+            messagebox.showinfo('Alert', maintenance.report_to_readable(event['report']), parent=self.settings_window)
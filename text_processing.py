@@ -4,8 +4,8 @@ import ollama
 # regex library used for processing LLaMa's output string
 import re
 
-# used to get the current date for timestamp search
-from datetime import datetime
+# used to get the current date for timestamp search, and to turn the times photos were taken into dates
+from datetime import datetime, timezone
 
 # constants that adjust how score is calculated
 LOCATION_FACTOR = 10
@@ -15,30 +15,32 @@ MONTH_FACTOR = 7
 DAY_FACTOR = 7
 MATCH_FACTOR = 7
 
-# turns a location in the form Latitude(°N),Longitude(°E) to Latitude° N/S, Longitude° E/W
+# turns a latitude and longitude in decimal degrees (negative for south and west) to Latitude° N/S, Longitude° E/W
 # used to display in image details
-def location_to_readable(location):
-    latitude, longitude = [float(n) for n in re.split(r',', location)]
+def location_to_readable(latitude, longitude):
     # find the direction letter to make the numbers positive and easier to read
     latitude_dir = 'S' if latitude < 0 else 'N'
-    longitude_dir = 'W' if longitude < 0 else 'E' 
-    
-    return f'{latitude}°  {latitude_dir}, {longitude}°  {longitude_dir}'
+    longitude_dir = 'W' if longitude < 0 else 'E'
+
+    return f'{round(abs(latitude), 4)}°  {latitude_dir}, {round(abs(longitude), 4)}°  {longitude_dir}'
+
+# turns the time a photo was taken, in seconds since 1970, to the date and time it was taken
+# photos store the time on their camera's clock as if it was UTC, so it's read back as UTC too
+def _taken_at_to_datetime(taken_at):
+    return datetime.fromtimestamp(taken_at, timezone.utc)
 
-# turns a timestamp in the form {year:month:day hours:minutes:seconds} to {month day, year hours:minutes AM/PM} 
+# turns the time a photo was taken, in seconds since 1970, to {month day, year hours:minutes AM/PM}
 # used to display in image details
-def timestamp_to_readable(timestamp):
-    # split the timestamp into date and time sections
-    date, time = re.findall(r'[^ ]+', timestamp)
+def timestamp_to_readable(taken_at):
+    taken_at = _taken_at_to_datetime(taken_at)
 
     # make the date readable and map the month from number to word
     months = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December']
-    year, month, day = re.findall(r'\d+', date)
-    readable_date = f'{months[int(month)-1]} {day}, {year}'
+    readable_date = f'{months[taken_at.month-1]} {taken_at.day}, {taken_at.year}'
 
     # get the time and make it readable (using AM/PM instead of 24 hours)
     # seconds are ignored
-    hours, minutes, seconds = [int(n) for n in re.findall(r'\d+', time)]
+    hours, minutes = taken_at.hour, taken_at.minute
     pm_bool = False
     if hours > 12:
         pm_bool = True
@@ -47,7 +49,7 @@ def timestamp_to_readable(timestamp):
         pm_bool = True
     elif hours == 0: 
         hours = 12
-    readable_time = f'{hours}:{minutes} {"PM" if pm_bool else "AM"}'
+    readable_time = f'{hours}:{minutes:02} {"PM" if pm_bool else "AM"}'
 
     return f'{readable_date}  {readable_time}'
 
@@ -130,6 +132,9 @@ def process_input(input, valid_tags, use_metadata):
     return (output_tags, None, None)
 
 # finds the images with the most similar tags to LLaMa's, and returns their filepaths
+# photos is the list of candidates from database_manager.search_photos_by_tags
+# each one is a tuple (filepath, latitude, longitude, taken_at, match_count) and has at least one tag in common with the request
+# the location and time are numbers, so nothing has to be parsed while the photos are scored
 def search(photos, request_output, max_photos):
     # get all the request data
     request_tags, request_location, request_timestamp = request_output
@@ -141,22 +146,21 @@ def search(photos, request_output, max_photos):
     if request_timestamp:
         request_year, request_month, request_day = request_timestamp
 
-    # list that keeps track of the number of similar tags for each photo
+    # list that keeps track of the score of each photo
     photo_scores = []
 
-    # iterate through the photos list
+    # iterate through the candidate photos
     for photo_data in photos:
         # get all the photo data
-        filepath, folder_path, location, timestamp, photo_tags, photo_faces = photo_data
-        print(filepath, location, timestamp, photo_tags)
+        filepath, latitude, longitude, taken_at, match_count = photo_data
+        print(filepath, latitude, longitude, taken_at, match_count)
         
         # score represents how strongly an image's data matches the request data
         # score from each section (location, timestamp, tags) is multiplied by a constant
         total_score = 0
 
         # calculate the score from location
-        if location and request_location:
-            latitude, longitude = [float(n) for n in re.split(r',', location)]
+        if latitude is not None and longitude is not None and request_location:
             # latitude and longitude are scored separately since LLaMa often misplaces a negative sign
             # score is calculated exponentially so only values close to the estimated result contribute meaningfully to the score
             latitude_score = METADATA_STRICTNESS ** -abs(latitude - request_latitude) * LOCATION_FACTOR
@@ -165,9 +169,9 @@ def search(photos, request_output, max_photos):
             print(f'Latitude/longitude scores: {latitude_score}, {longitude_score}')
         
         # calculate the score from timestamp
-        if timestamp and request_timestamp:
-            date = re.search(r'[^ ]+', timestamp)[0]
-            year, month, day = [int(n) for n in re.findall(r'\d+', date)]
+        if taken_at is not None and request_timestamp:
+            date = _taken_at_to_datetime(taken_at)
+            year, month, day = date.year, date.month, date.day
             # timestamp score is calculated similarly to location
             year_score = METADATA_STRICTNESS ** -abs(year - request_year) * YEAR_FACTOR
             month_score = METADATA_STRICTNESS ** -abs(month - request_month) * MONTH_FACTOR
@@ -176,16 +180,13 @@ def search(photos, request_output, max_photos):
             print(f'Year/month/day scores: {year_score}, {month_score}, {day_score}')
         
 
-        # count the number of tags the request_tags and photo_tags have in common
-        match_score = sum([tag in request_tags for tag in photo_tags]) * MATCH_FACTOR
+        # the number of tags the request and photo have in common was already counted by the database
+        match_score = match_count * MATCH_FACTOR
         total_score += match_score
 
         # add the result to photo_scores
         photo_scores.append((total_score, filepath))
         print(f'Total score: {total_score}')
-    
-    # filters out photos with zero tags in common
-    photo_scores = [photo for photo in photo_scores if photo[0] > 0]
 
     # don't display any images if none match
     # most likely, something went wrong with LLaMa's response
@@ -199,4 +200,3 @@ def search(photos, request_output, max_photos):
     # map the list of (filepath, score) to only a list of filepaths
     photo_paths = [photo[1] for photo in best_photos]
     return photo_paths
-